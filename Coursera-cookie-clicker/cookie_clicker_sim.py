@@ -4,6 +4,9 @@ Cookie Clicker Simulator
 
 import simpleplot
 import math
+import array
+import json
+import time
 
 # Used to increase the timeout, if necessary
 import codeskulptor
@@ -16,17 +19,117 @@ import poc_clicker_provided as provided
 
 SIM_TIME = 100000.0
 
+# Search nodes strategy_best may visit on each purchase decision beyond
+# the first purchase, which is always searched.  A node budget keeps
+# simulations and tournaments reproducible
+PLAN_NODE_BUDGET = 2000
+
+# Optional seconds strategy_best may spend on each purchase decision,
+# None leaves only the node budget
+PLAN_TIME_BUDGET = None
+
+# Longest sequence of purchases strategy_best looks ahead
+PLAN_HORIZON = 4
+
+class ClickerHistory:
+    """
+    Purchase history stored column by column in typed arrays of time,
+    item id, cost of item and total cookies.  Each item name is stored
+    once and referred to by its id; the id -1 stands for None.
+    """
+
+    def __init__(self):
+        self._times = array.array('d')
+        self._item_ids = array.array('l')
+        self._costs = array.array('d')
+        self._totals = array.array('d')
+        self._item_names = []
+        self._name_ids = {}
+        self.append(0.0, None, 0.0, 0.0)
+
+    def __len__(self):
+        """
+        Return number of entries
+        """
+        return len(self._times)
+
+    def __getitem__(self, idx):
+        """
+        Return entry idx as a (time, item, cost of item, total cookies)
+        tuple, or a list of such tuples if idx is a slice
+        """
+        if isinstance(idx, slice):
+            return [self[pos] for pos in range(*idx.indices(len(self)))]
+        item_id = self._item_ids[idx]
+        if item_id < 0:
+            item = None
+        else:
+            item = self._item_names[item_id]
+        return (self._times[idx], item, self._costs[idx], self._totals[idx])
+
+    def __iter__(self):
+        """
+        Yield the entries in order
+        """
+        for idx in range(len(self._times)):
+            yield self[idx]
+
+    def append(self, time, item, cost, total_cookies):
+        """
+        Add an entry to the end of the history
+        """
+        if item == None:
+            item_id = -1
+        else:
+            item_id = self._name_ids.get(item)
+            if item_id == None:
+                item_id = len(self._item_names)
+                self._item_names.append(item)
+                self._name_ids[item] = item_id
+        self._times.append(time)
+        self._item_ids.append(item_id)
+        self._costs.append(cost)
+        self._totals.append(total_cookies)
+
+
+class HistoryView:
+    """
+    Read-only view of a ClickerHistory, which also sees entries added
+    after the view was made.  Supports len, indexing, slicing and
+    iteration like the list returned by get_history.
+    """
+
+    def __init__(self, history):
+        self._history = history
+
+    def __len__(self):
+        return len(self._history)
+
+    def __getitem__(self, idx):
+        return self._history[idx]
+
+    def __iter__(self):
+        return iter(self._history)
+
+
 class ClickerState:
     """
     Simple class to keep track of the game state.
     """
     
-    def __init__(self):
-        self._total_cookies_produced = 0.0 
-        self._current_cookies = 0.0
-        self._current_time = 0.0 
-        self._cps = 1.0 
-        self._history_list = [(0.0, None, 0.0, 0.0)]
+    def __init__(self, total_cookies = 0.0, cookies = 0.0, now = 0.0, 
+                 cps = 1.0, history = None):
+        """
+        Start a new game, or resume one from its total cookies, current
+        cookies, time, CPS and ClickerHistory
+        """
+        self._total_cookies_produced = total_cookies 
+        self._current_cookies = cookies
+        self._current_time = now 
+        self._cps = cps 
+        if history == None:
+            history = ClickerHistory()
+        self._history = history
         
     def __str__(self):
         """
@@ -56,6 +159,14 @@ class ClickerState:
         """
         return self._cps
     
+    def get_total_cookies(self):
+        """
+        Get total number of cookies produced
+
+        Should return a float
+        """
+        return self._total_cookies_produced
+    
     def get_time(self):
         """
         Get current time
@@ -76,10 +187,17 @@ class ClickerState:
         Should return a copy of any internal data structures,
         so that they will not be modified outside of the class.
         """ 
-        history = self._history_list[:]
+        history = list(self._history)
         
         return history  
 
+    def get_history_view(self):
+        """
+        Return a read-only HistoryView of the history, which is not a
+        copy and stays up to date as items are bought
+        """
+        return HistoryView(self._history)
+
     def time_until(self, cookies):
         """
         Return time until you have the given number of cookies
@@ -117,41 +235,232 @@ class ClickerState:
             self._current_cookies -= cost
             self._cps += additional_cps
             
-            snapshot = (self.get_time(), item_name, cost, self._total_cookies_produced)
-            self._history_list.append(snapshot)
+            self._history.append(self.get_time(), item_name, cost,
+                                 self._total_cookies_produced)
             
     
-def simulate_clicker(build_info, duration, strategy):
+class SimProfile:
+    """
+    Instrumentation collected by simulate_clicker when passed as its
+    profile argument: time spent in each phase of the loop, counters,
+    and a trace of the game state sampled every sample_every steps.
+
+    Phases are "strategy" (strategy calls), "build_info" (build_clone
+    cloning, costs and updates) and "state" (ClickerState time_until,
+    wait and buy_item).  Strategies read the history through a view
+    shared for the whole game, so that time is part of "strategy".
+    """
+
+    PHASES = ("strategy", "build_info", "state")
+
+    def __init__(self, sample_every = 100):
+        self._sample_every = sample_every
+        self._timers = dict((phase, 0.0) for phase in self.PHASES)
+        self._counters = {"steps": 0, "purchases": 0}
+        self._trace = []
+
+    def __str__(self):
+        """
+        Return human readable timers and counters
+        """
+        timers = ", ".join(phase + ": " + str(self._timers[phase]) + "s"
+                           for phase in self.PHASES)
+        counters = ", ".join(name + ": " + str(count)
+                             for name, count in sorted(self._counters.items()))
+        return timers + " " + counters
+
+    def lap(self, phase, mark):
+        """
+        Add the time since mark to phase and return the current time
+        """
+        now = time.time()
+        self._timers[phase] += now - mark
+        return now
+
+    def record_step(self, click, item):
+        """
+        Count one strategy call that chose item, and sample the state
+        of click every sample_every steps
+        """
+        if self._counters["steps"] % self._sample_every == 0:
+            self._trace.append((self._counters["steps"], click.get_time(),
+                                click.get_cookies(), click.get_cps(),
+                                click.get_total_cookies(), item))
+        self._counters["steps"] += 1
+
+    def finish(self, click):
+        """
+        Record the final state of click
+        """
+        self._counters["purchases"] = len(click.get_history_view()) - 1
+        self._trace.append((self._counters["steps"], click.get_time(),
+                            click.get_cookies(), click.get_cps(),
+                            click.get_total_cookies(), None))
+
+    def get_timers(self):
+        """
+        Return a dictionary of seconds spent in each phase
+        """
+        return dict(self._timers)
+
+    def get_counters(self):
+        """
+        Return a dictionary of steps (strategy calls) and purchases
+        """
+        return dict(self._counters)
+
+    def get_trace(self):
+        """
+        Return the sampled trace as a list of tuples of the form:
+        (step, time, current cookies, cps, total cookies, item)
+        """
+        return self._trace[:]
+
+    def export(self, filename):
+        """
+        Save timers, counters and trace to filename as JSON
+        """
+        out_file = open(filename, "w")
+        try:
+            json.dump({"timers": self._timers, "counters": self._counters,
+                       "trace": self._trace}, out_file)
+        finally:
+            out_file.close()
+    
+def simulate_clicker(build_info, duration, strategy, profile = None):
     """
     Function to run a Cookie Clicker game for the given
     duration with the given strategy.  Returns a ClickerState
     object corresponding to the final state of the game.
+
+    If profile is a SimProfile it collects timings, counters and a
+    sampled trace of the run; without one the only cost is a few
+    checks per step.
     """
+    profiling = profile != None
+    if profiling:
+        mark = time.time()
     
     build_clone = build_info.clone()
     click = ClickerState()
+    if profiling:
+        mark = profile.lap("build_info", mark)
+    # strategies only read the history, so they share one view of it
+    history = click.get_history_view()
     
     while click.get_time() <= duration:
-        item = strategy(click.get_cookies(), click.get_cps(), click.get_history(), 
+        item = strategy(click.get_cookies(), click.get_cps(), history, 
                  (duration - click.get_time()), build_clone)
+        if profiling:
+            mark = profile.lap("strategy", mark)
+            profile.record_step(click, item)
         
         if item == None:
             break 
         
         item_cost = build_clone.get_cost(item)
+        if profiling:
+            mark = profile.lap("build_info", mark)
         time_until = click.time_until(item_cost)
         
         if time_until + click.get_time() <= duration: 
             click.wait(time_until)
             click.buy_item(item, item_cost, build_clone.get_cps(item))
+            if profiling:
+                mark = profile.lap("state", mark)
             build_clone.update_item(item)
+            if profiling:
+                mark = profile.lap("build_info", mark)
         else: 
             break
             
     click.wait((duration - click.get_time()))
+    if profiling:
+        profile.lap("state", mark)
+        profile.finish(click)
        
     return click 
 
+def simulate_clicker_fast(build_info, duration, strategy):
+    """
+    Event driven version of simulate_clicker that returns an identical
+    ClickerState.
+
+    The game state is kept in local variables and the loop jumps from
+    one purchase straight to the next.  Strategies with a kernel in
+    FAST_STRATEGIES are run through the kernel on flat lists of items
+    and costs, and item costs are grown in place without touching a
+    BuildInfo.  Other strategies are called as usual and get a BuildInfo
+    that is kept up to date.
+    """
+    build_clone = build_info.clone()
+    item_list = build_clone.build_items()
+    item_index = dict((item, idx) for idx, item in enumerate(item_list))
+    costs = [build_clone.get_cost(item) for item in item_list]
+    item_cps = [build_clone.get_cps(item) for item in item_list]
+    kernel = FAST_STRATEGIES.get(strategy)
+
+    # growth factor of each item cost, measured once on another clone
+    growth_clone = build_info.clone()
+    growth = []
+    for idx, item in enumerate(item_list):
+        growth_clone.update_item(item)
+        growth.append(growth_clone.get_cost(item) / costs[idx])
+
+    total_cookies = 0.0
+    cookies = 0.0
+    now = 0.0
+    cps = 1.0
+    history = ClickerHistory()
+    history_view = HistoryView(history)
+
+    while now <= duration:
+        if kernel != None:
+            item = kernel(cookies, cps, duration - now, item_list, costs)
+        else:
+            item = strategy(cookies, cps, history_view, duration - now, build_clone)
+
+        if item == None:
+            break
+
+        idx = item_index[item]
+        item_cost = costs[idx]
+
+        # same arithmetic as ClickerState.time_until, wait and buy_item
+        cookies_needed = item_cost - cookies
+        if cookies_needed < 0:
+            time_until = 0.0
+        else:
+            time_until = math.ceil(float(cookies_needed / cps))
+
+        if time_until + now <= duration:
+            if time_until > 0.0:
+                cookies_prod = time_until * cps
+                total_cookies += cookies_prod
+                cookies += cookies_prod
+                now += time_until
+            if cookies >= item_cost:
+                cookies -= item_cost
+                cps += item_cps[idx]
+                history.append(now, item, item_cost, total_cookies)
+            if kernel != None:
+                costs[idx] *= growth[idx]
+            else:
+                # the strategy reads build_clone, so it has to be updated
+                build_clone.update_item(item)
+                costs[idx] = build_clone.get_cost(item)
+        else:
+            break
+
+    time_left = duration - now
+    if time_left > 0.0:
+        cookies_prod = time_left * cps
+        total_cookies += cookies_prod
+        cookies += cookies_prod
+        now += time_left
+
+    return ClickerState(total_cookies, cookies, now, cps, history)
+
 def strategy_cursor_broken(cookies, cps, history, time_left, build_info):
     """
     Always pick Cursor!
@@ -213,23 +522,170 @@ def strategy_expensive(cookies, cps, history, time_left, build_info):
     else: 
         return None
 
+class PlanTimeout(Exception):
+    """
+    Raised inside plan_purchases when its node or time budget runs out
+    """
+    pass
+
+def purchase_wait(cookies, cps, cost):
+    """
+    Return the whole seconds to wait until cost cookies can be spent
+    """
+    cookies_needed = cost - cookies
+    if cookies_needed < 0:
+        return 0.0
+    return math.ceil(float(cookies_needed / cps))
+
+def plan_purchases(cookies, cps, time_left, costs, item_cps, growth,
+                   depth, budget, memo):
+    """
+    Branch and bound search over sequences of at most depth purchases.
+
+    costs, item_cps and growth are tuples with the current cost, the
+    CPS and the cost growth factor of each item.  A branch is cut when
+    even buying depth of the highest CPS items right away could not
+    beat the best sequence found so far.  Results are memoized on the
+    whole state, including CPS and build costs.
+
+    budget is None or a dictionary with the "nodes" left to visit and
+    the "deadline" time, either of which may be None.  PlanTimeout is
+    raised once one of them runs out.
+
+    Returns a tuple (cookies produced in time_left, index of the first
+    item to buy or None)
+    """
+    key = (cookies, cps, time_left, costs, depth)
+    if key in memo:
+        return memo[key]
+    if budget != None:
+        if budget["nodes"] != None:
+            budget["nodes"] -= 1
+            if budget["nodes"] < 0:
+                raise PlanTimeout()
+        if budget["deadline"] != None and time.time() > budget["deadline"]:
+            raise PlanTimeout()
+
+    best = (cps * time_left, None)
+    if depth > 0:
+        max_cps = max(item_cps)
+        for idx in range(len(costs)):
+            wait = purchase_wait(cookies, cps, costs[idx])
+            if wait > time_left:
+                continue
+
+            # upper bound on what this branch can produce
+            bound = cps * wait + (cps + item_cps[idx] + (depth - 1) * max_cps) * (time_left - wait)
+            if bound <= best[0]:
+                continue
+
+            new_costs = costs[:idx] + (costs[idx] * growth[idx],) + costs[idx + 1:]
+            value, dummy_item = plan_purchases(cookies + cps * wait - costs[idx],
+                                               cps + item_cps[idx], time_left - wait,
+                                               new_costs, item_cps, growth,
+                                               depth - 1, budget, memo)
+            if cps * wait + value > best[0]:
+                best = (cps * wait + value, idx)
+
+    memo[key] = best
+    return best
+
 def strategy_best(cookies, cps, history, time_left, build_info):
     """
     The best strategy that you are able to implement.
+
+    Looks ahead over sequences of purchases with plan_purchases, one
+    purchase deeper at a time until PLAN_HORIZON or the node or time
+    budget is reached, and buys the first item of the best sequence
+    found.  The first purchase is always searched in full, so None is
+    only returned when no item can be bought in time_left.
     """
+    if PLAN_TIME_BUDGET == None:
+        deadline = None
+    else:
+        deadline = time.time() + PLAN_TIME_BUDGET
     item_list = build_info.build_items()
-    items_costs = map(build_info.get_cost, item_list) 
-    
-    indv_cost = min(items_costs)
-    choice = items_costs.index(indv_cost)
-    final_choice = item_list[choice]
-    
-    
+    costs = tuple(map(build_info.get_cost, item_list))
+    item_cps = tuple(map(build_info.get_cps, item_list))
+
+    # growth factor of each item cost, measured on a clone
+    build_clone = build_info.clone()
+    growth = []
+    for item in item_list:
+        build_clone.update_item(item)
+        growth.append(build_clone.get_cost(item) / build_info.get_cost(item))
+    growth = tuple(growth)
+
+    memo = {}
+    dummy_value, choice = plan_purchases(cookies, cps, time_left, costs, item_cps,
+                                         growth, 1, None, memo)
+    budget = {"nodes": PLAN_NODE_BUDGET, "deadline": deadline}
+    for depth in range(2, PLAN_HORIZON + 1):
+        try:
+            dummy_value, choice = plan_purchases(cookies, cps, time_left, costs, item_cps,
+                                                 growth, depth, budget, memo)
+        except PlanTimeout:
+            break
+
+    if choice == None:
+        # no purchase adds cookies, but keep buying the cheapest item
+        # that still fits so the game only stops when nothing does
+        fits = [(costs[idx], idx) for idx in range(len(costs))
+                if purchase_wait(cookies, cps, costs[idx]) <= time_left]
+        if fits == []:
+            return None
+        choice = min(fits)[1]
+    return item_list[choice]
+        
+# Kernels used by simulate_clicker_fast in place of the matching
+# strategy functions.  A kernel is called as
+# kernel(cookies, cps, time_left, item_list, costs), where costs[idx] is
+# the current cost of item_list[idx], and must return the same item
+# as its strategy.
+
+def kernel_cursor_broken(cookies, cps, time_left, item_list, costs):
+    """
+    Kernel for strategy_cursor_broken
+    """
+    return "Cursor"
+
+def kernel_none(cookies, cps, time_left, item_list, costs):
+    """
+    Kernel for strategy_none
+    """
+    return None
+
+def kernel_cheap(cookies, cps, time_left, item_list, costs):
+    """
+    Kernel for strategy_cheap
+    """
+    indv_cost = min(costs)
     if time_left >= (indv_cost - cookies / cps):
-        return final_choice
-    else: 
+        return item_list[costs.index(indv_cost)]
+    else:
         return None
-        
+
+def kernel_expensive(cookies, cps, time_left, item_list, costs):
+    """
+    Kernel for strategy_expensive
+    """
+    total_cookies = (time_left * cps + cookies)
+    current_choice = 0
+    max_choice = ''
+    for item in costs:
+        if item > current_choice and item <= total_cookies:
+            current_choice = item
+            max_choice = item_list[costs.index(item)]
+    if time_left >= (current_choice - cookies / cps):
+        return max_choice
+    else:
+        return None
+
+FAST_STRATEGIES = {strategy_cursor_broken: kernel_cursor_broken,
+                   strategy_none: kernel_none,
+                   strategy_cheap: kernel_cheap,
+                   strategy_expensive: kernel_expensive}
+
 def run_strategy(strategy_name, time, strategy):
     """
     Run a simulation for the given time with one strategy.
@@ -246,6 +702,111 @@ def run_strategy(strategy_name, time, strategy):
     # history = [(item[0], item[3]) for item in history]
     # simpleplot.plot_lines(strategy_name, 1000, 400, 'Time', 'Total Cookies', [history], True)
 
+# Strategies evaluated by run_tournament, keyed on name
+STRATEGIES = {"Cheap": strategy_cheap,
+              "Expensive": strategy_expensive,
+              "Best": strategy_best}
+
+def register_strategy(strategy_name, strategy):
+    """
+    Add a strategy to STRATEGIES.  It has to be a module level function
+    so that it can be sent to the tournament worker processes.
+    """
+    STRATEGIES[strategy_name] = strategy
+
+def make_build_configs(cost_scales = (0.5, 1.0, 2.0), cps_scales = (0.5, 1.0, 2.0)):
+    """
+    Return a list of (label, build info dictionary) pairs, one for each
+    combination of scale factors applied to the costs and CPS of the
+    default provided.BuildInfo items.
+    """
+    base = provided.BuildInfo()
+    configs = []
+    for cost_scale in cost_scales:
+        for cps_scale in cps_scales:
+            info = dict((item, [base.get_cost(item) * cost_scale,
+                                base.get_cps(item) * cps_scale])
+                        for item in base.build_items())
+            configs.append(("cost x" + str(cost_scale) + " cps x" + str(cps_scale), info))
+    return configs
+
+def run_match(match):
+    """
+    Process pool task for run_tournament: simulate one strategy on one
+    build configuration and duration.
+
+    Returns (strategy name, config label, duration, total cookies), with
+    None as the total if the strategy failed.
+    """
+    strategy_name, strategy, label, info, duration = match
+    try:
+        state = simulate_clicker_fast(provided.BuildInfo(info), duration, strategy)
+    except (KeyError, ValueError, ZeroDivisionError):
+        # broken strategies, such as ones naming items that do not exist
+        return strategy_name, label, duration, None
+    return strategy_name, label, duration, state.get_total_cookies()
+
+def run_tournament(strategies = None, configs = None, durations = (SIM_TIME,),
+                   workers = None):
+    """
+    Evaluate every strategy against every build configuration and
+    duration in a process pool and print a ranked summary table.
+
+    strategies: dictionary of name to strategy, defaults to STRATEGIES
+    configs: list of (label, build info dictionary) pairs, defaults to
+    make_build_configs()
+    workers: size of the process pool, None uses one process per CPU
+
+    Returns the table as a list of (name, wins, mean share of the best
+    total, mean total cookies, failures) tuples, best strategy first.
+    """
+    import multiprocessing
+
+    if strategies == None:
+        strategies = STRATEGIES
+    if configs == None:
+        configs = make_build_configs()
+
+    matches = [(strategy_name, strategy, label, info, duration)
+               for strategy_name, strategy in sorted(strategies.items())
+               for label, info in configs
+               for duration in durations]
+    pool = multiprocessing.Pool(workers)
+    try:
+        results = pool.map(run_match, matches)
+    finally:
+        pool.terminate()
+        pool.join()
+
+    # best total of each scenario, to score strategies relative to it
+    best = {}
+    for strategy_name, label, duration, total in results:
+        if total != None:
+            best[(label, duration)] = max(best.get((label, duration), 0.0), total)
+
+    stats = dict((strategy_name, [0, 0.0, 0.0, 0]) for strategy_name in strategies)
+    for strategy_name, label, duration, total in results:
+        entry = stats[strategy_name]
+        if total == None:
+            entry[3] += 1
+            continue
+        if total == best[(label, duration)]:
+            entry[0] += 1
+        if best[(label, duration)] > 0:
+            entry[1] += total / best[(label, duration)]
+        entry[2] += total
+
+    num_scenarios = len(configs) * len(durations)
+    table = [(strategy_name, wins, share / num_scenarios, total / num_scenarios, failures)
+             for strategy_name, (wins, share, total, failures) in stats.items()]
+    table.sort(key = lambda row: (-row[2], -row[1], row[0]))
+
+    print "Rank Strategy        Wins  Share  Mean total        Failures"
+    for rank, (strategy_name, wins, share, total, failures) in enumerate(table):
+        print "%4d %-15s %4d  %5.3f  %-16.6g  %d" % (rank + 1, strategy_name, wins,
+                                                     share, total, failures)
+    return table
+
 def run():
     """
     Run the simulator.
@@ -256,6 +817,9 @@ def run():
     # run_strategy("Cheap", SIM_TIME, strategy_cheap)
     # run_strategy("Expensive", SIM_TIME, strategy_expensive)
     # run_strategy("Best", SIM_TIME, strategy_best)
+
+    # Compare all registered strategies over many build configurations
+    # run_tournament(durations = (SIM_TIME, 10 * SIM_TIME))
     
 run()
     
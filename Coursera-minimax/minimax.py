@@ -2,6 +2,8 @@
 Mini-max Tic-Tac-Toe Player
 """
 
+import collections
+import time
 import poc_ttt_gui
 import poc_ttt_provided as provided
 
@@ -17,13 +19,135 @@ SCORES = {provided.PLAYERX: 1,
           provided.DRAW: 0,
           provided.PLAYERO: -1}
 
-def mm_move(board, player):
+# Maximum number of positions kept in a transposition table
+TABLE_SIZE = 200000
+
+# Seconds allowed per move_wrapper call, None searches to the end
+TIME_BUDGET = None
+
+# Search a ttt_bitboard.BitBoard copy of the board in move_wrapper.
+# ttt_bitboard lives in Coursera-tic-tac-toe-MC, which must be on the
+# path, so it is only imported when this is set
+USE_BITBOARD = False
+
+# Worker processes used by move_wrapper, more than 1 splits the root
+# moves of the search across a process pool
+WORKERS = 1
+
+# Heuristic scores of unfinished boards stay strictly inside (-1, 1)
+# so that a forced win or loss always outranks them
+HEURISTIC_WEIGHT = 0.5
+
+
+class TranspositionTable:
+    """
+    Bounded cache of mini-max scores keyed on canonical board encodings.
+    Least recently used entries are evicted once the table is full.
+    """
+
+    def __init__(self, max_size = TABLE_SIZE):
+        self._max_size = max_size
+        self._entries = collections.OrderedDict()
+        self._hits = 0
+        self._misses = 0
+
+    def __str__(self):
+        """
+        Return human readable table statistics
+        """
+        return ("Entries: " + str(len(self._entries)) + " Hits: " +
+                str(self._hits) + " Misses: " + str(self._misses))
+
+    def __len__(self):
+        """
+        Return number of cached positions
+        """
+        return len(self._entries)
+
+    def lookup(self, key):
+        """
+        Return the cached score for key, or None if it is not cached
+        """
+        score = self._entries.pop(key, None)
+        if score == None:
+            self._misses += 1
+            return None
+        # reinsert so the entry becomes the most recently used one
+        self._entries[key] = score
+        self._hits += 1
+        return score
+
+    def store(self, key, score):
+        """
+        Cache score for key, evicting the least recently used entry
+        if the table is full
+        """
+        if key in self._entries:
+            del self._entries[key]
+        elif len(self._entries) >= self._max_size:
+            self._entries.popitem(last = False)
+        self._entries[key] = score
+
+    def get_hits(self):
+        """
+        Return number of lookups that found a cached score
+        """
+        return self._hits
+
+    def get_misses(self):
+        """
+        Return number of lookups that did not find a cached score
+        """
+        return self._misses
+
+    def clear(self):
+        """
+        Remove all entries and reset the hit and miss counters
+        """
+        self._entries.clear()
+        self._hits = 0
+        self._misses = 0
+
+
+def canonical_key(board, player):
+    """
+    Return a hashable encoding of board and player that is identical
+    for all 8 rotations and reflections of a square board.
+
+    The reverse flag of the board is part of the key, since the same
+    squares score differently in a reverse game.  TTTBoard has no
+    getter for it, so it is read from its _reverse attribute.
+    """
+    reverse = getattr(board, "_reverse", False)
+    dim = board.get_dim()
+    last = dim - 1
+    squares = [[board.square(row, col) for col in range(dim)]
+               for row in range(dim)]
+    # each transform maps (row, col) of the encoding to a board square
+    transforms = [lambda row, col: squares[row][col],
+                  lambda row, col: squares[col][last - row],
+                  lambda row, col: squares[last - row][last - col],
+                  lambda row, col: squares[last - col][row],
+                  lambda row, col: squares[row][last - col],
+                  lambda row, col: squares[last - row][col],
+                  lambda row, col: squares[col][row],
+                  lambda row, col: squares[last - col][last - row]]
+    encodings = [tuple(transform(row, col) for row in range(dim)
+                       for col in range(dim))
+                 for transform in transforms]
+    return reverse, player, min(encodings)
+
+
+def mm_move(board, player, table = None):
     """
     Make a move on the board.
     
     Returns a tuple with two elements.  The first element is the score
     of the given board and the second element is the desired move as a
     tuple, (row, col).
+
+    If table is a TranspositionTable, scores of positions below the
+    root are looked up in and stored to it.
     """ 
     
     if board.check_win() != None:  
@@ -42,9 +166,20 @@ def mm_move(board, player):
         # Changes player before making another move, need throw away variable 
         # because func returns score and move 
         if SCORES[player] == 1: 
-            score, _ = mm_move(board_copy, provided.PLAYERO)
+            next_player = provided.PLAYERO
         else: 
-            score, _ = mm_move(board_copy, provided.PLAYERX)            
+            next_player = provided.PLAYERX
+
+        if table == None:
+            score, _ = mm_move(board_copy, next_player)
+        else:
+            # the score of a position does not depend on its orientation,
+            # so a cached score can be reused for any symmetric board
+            key = canonical_key(board_copy, next_player)
+            score = table.lookup(key)
+            if score == None:
+                score, _ = mm_move(board_copy, next_player, table)
+                table.store(key, score)
  
         if score * SCORES[player] == 1: 
             return score, move 
@@ -59,12 +194,352 @@ def mm_move(board, player):
 
 #zk.run_suite(mm_move)
 
-def move_wrapper(board, player, trials):
+
+class SearchTimeout(Exception):
+    """
+    Raised inside the alpha-beta search when its deadline has passed
+    """
+    pass
+
+
+# Cache of winning lines for each board dimension
+LINES = {}
+
+def get_lines(dim):
+    """
+    Return the rows, columns and diagonals of a dim x dim board as
+    lists of (row, col) tuples
+    """
+    if dim not in LINES:
+        lines = [[(row, col) for col in range(dim)] for row in range(dim)]
+        lines += [[(row, col) for row in range(dim)] for col in range(dim)]
+        lines.append([(idx, idx) for idx in range(dim)])
+        lines.append([(idx, dim - idx - 1) for idx in range(dim)])
+        LINES[dim] = lines
+    return LINES[dim]
+
+
+def evaluate(board):
+    """
+    Heuristic score of an unfinished board from PLAYERX's point of view,
+    based on how many lines are still open to each player
+    """
+    lines = get_lines(board.get_dim())
+    balance = 0
+    for line in lines:
+        marks = set([board.square(row, col) for row, col in line])
+        if provided.PLAYERO not in marks:
+            balance += 1
+        if provided.PLAYERX not in marks:
+            balance -= 1
+    return HEURISTIC_WEIGHT * balance / float(len(lines))
+
+
+def order_moves(board, moves):
+    """
+    Return moves sorted so squares closest to the center come first
+    """
+    center = (board.get_dim() - 1) / 2.0
+    return sorted(moves, key = lambda move: abs(move[0] - center) +
+                  abs(move[1] - center))
+
+
+def alpha_beta(board, player, depth, alpha, beta, deadline, stats):
+    """
+    Depth limited mini-max score of board with alpha-beta pruning.
+
+    PLAYERX maximizes and PLAYERO minimizes.  Boards still unfinished
+    at depth 0 are scored by evaluate and flagged in stats.  Raises
+    SearchTimeout once time.time() passes deadline.
+    """
+    if deadline != None and time.time() > deadline:
+        raise SearchTimeout()
+    stats["nodes"] += 1
+    # searches run in a pool worker also stop once the parent process
+    # has moved on, checked every 256 nodes to keep it cheap
+    if "search" in stats and stats["nodes"] & 255 == 0 and \
+       SEARCH_ID.value != stats["search"]:
+        raise SearchTimeout()
+
+    winner = board.check_win()
+    if winner != None:
+        return SCORES[winner]
+    if depth == 0:
+        stats["truncated"] = True
+        return evaluate(board)
+
+    next_player = provided.switch_player(player)
+    best = -SCORES[player] * 2
+    for move in order_moves(board, board.get_empty_squares()):
+        board_copy = board.clone()
+        board_copy.move(move[0], move[1], player)
+        score = alpha_beta(board_copy, next_player, depth - 1,
+                           alpha, beta, deadline, stats)
+        if player == provided.PLAYERX:
+            best = max(best, score)
+            alpha = max(alpha, score)
+        else:
+            best = min(best, score)
+            beta = min(beta, score)
+        if alpha >= beta:
+            break
+    return best
+
+
+def ab_move(board, player, time_budget = None, max_depth = None):
+    """
+    Make a move on the board using iterative deepening alpha-beta search.
+
+    Each iteration searches one ply deeper, starting from the best move
+    of the previous one, until the game tree is searched to the end, a
+    forced result is found, max_depth is reached or time_budget seconds
+    have passed.
+
+    Returns a tuple with three elements: the score of the given board,
+    the best move found as a tuple (row, col) and the deepest search
+    depth that was completed.
+    """
+    if board.check_win() != None:
+        return SCORES[board.check_win()], (-1, -1), 0
+
+    if time_budget == None:
+        deadline = None
+    else:
+        deadline = time.time() + time_budget
+
+    moves = order_moves(board, board.get_empty_squares())
+    if max_depth == None:
+        max_depth = len(moves)
+    next_player = provided.switch_player(player)
+    result = (evaluate(board), moves[0], 0)
+
+    for depth in range(1, max_depth + 1):
+        stats = {"nodes": 0, "truncated": False}
+        alpha, beta = -2, 2
+        best_score, best_move = None, None
+        try:
+            for move in moves:
+                board_copy = board.clone()
+                board_copy.move(move[0], move[1], player)
+                score = alpha_beta(board_copy, next_player, depth - 1,
+                                   alpha, beta, deadline, stats)
+                if best_move == None or score * SCORES[player] > best_score * SCORES[player]:
+                    best_score, best_move = score, move
+                if player == provided.PLAYERX:
+                    alpha = max(alpha, score)
+                else:
+                    beta = min(beta, score)
+        except SearchTimeout:
+            # keep the result of the last depth that was fully searched
+            break
+
+        result = (best_score, best_move, depth)
+        # search the best move first on the next, deeper iteration
+        moves.remove(best_move)
+        moves.insert(0, best_move)
+        if not stats["truncated"] or abs(best_score) == 1:
+            break
+
+    return result
+
+
+# Process pool shared by the parallel searches, created on first use
+POOL = None
+POOL_WORKERS = None
+
+# Id of the parallel search in progress, in memory shared with the pool
+# workers.  Changing it makes workers drop tasks of older searches
+SEARCH_ID = None
+
+def init_worker(search_id):
+    """
+    Process pool initializer: share the search id with the parent
+    """
+    global SEARCH_ID
+    SEARCH_ID = search_id
+
+
+def get_pool(workers = None):
+    """
+    Return the process pool with workers processes, None uses one per
+    CPU.  The pool is kept between calls and only rebuilt when the
+    number of workers changes.
+    """
+    global POOL, POOL_WORKERS, SEARCH_ID
+    import multiprocessing
+
+    if POOL != None and POOL_WORKERS == workers:
+        return POOL
+    shutdown_pool()
+    if SEARCH_ID == None:
+        SEARCH_ID = multiprocessing.RawValue("i", 0)
+    POOL = multiprocessing.Pool(workers, init_worker, (SEARCH_ID,))
+    POOL_WORKERS = workers
+    return POOL
+
+
+def shutdown_pool():
+    """
+    Stop the worker processes of the shared pool
+    """
+    global POOL, POOL_WORKERS
+    if POOL != None:
+        POOL.terminate()
+        POOL.join()
+    POOL, POOL_WORKERS = None, None
+
+
+def next_search():
+    """
+    Start a new parallel search, which cancels the tasks of earlier
+    ones, and return its id
+    """
+    SEARCH_ID.value += 1
+    return SEARCH_ID.value
+
+
+def score_root_move(board, player, move, depth, deadline, search):
+    """
+    Process pool task: return a tuple of the alpha-beta score of board
+    after player makes move, searched depth more plies, and whether the
+    search was cut off by depth.  Returns None if the deadline passed or
+    the search was cancelled.
+    """
+    if SEARCH_ID.value != search:
+        return None
+    board_copy = board.clone()
+    board_copy.move(move[0], move[1], player)
+    stats = {"nodes": 0, "truncated": False, "search": search}
+    try:
+        score = alpha_beta(board_copy, provided.switch_player(player),
+                           depth, -2, 2, deadline, stats)
+    except SearchTimeout:
+        return None
+    return score, stats["truncated"]
+
+
+def mm_move_parallel(board, player, workers = None):
+    """
+    Make a move on the board, scoring each root move in its own process.
+
+    Returns the same (score, move) tuple as mm_move.  workers is the
+    size of the process pool, None uses one process per CPU.  Each root
+    move is searched to the end by alpha_beta, which gives the exact
+    mini-max score and can be cancelled once a winning move is found.
+    """
+    if board.check_win() != None:
+        return SCORES[board.check_win()], (-1, -1)
+
+    possible_moves = board.get_empty_squares()
+    depth = len(possible_moves)
+
+    result = (-1, (-1, -1))
+
+    pool = get_pool(workers)
+    search = next_search()
+    try:
+        pending = [pool.apply_async(score_root_move, (board, player, move,
+                                                      depth, None, search))
+                   for move in possible_moves]
+
+        # merge scores in move order with the same rules as mm_move, so
+        # the first winning move wins and otherwise the last draw is kept
+        for move, task in zip(possible_moves, pending):
+            score, _ = task.get()
+            if score * SCORES[player] == 1:
+                return score, move
+
+            elif score * SCORES[player] == 0:
+                result = (score, move)
+
+            elif result[0] == -1:
+                result = (result[0], move)
+    finally:
+        # stop the workers still searching subtrees that are not needed
+        next_search()
+
+    return result[0] * SCORES[player], result[1]
+
+
+def ab_move_parallel(board, player, time_budget = None, max_depth = None,
+                     workers = None):
+    """
+    Make a move on the board using iterative deepening alpha-beta search
+    with the root moves of each depth split across the process pool.
+
+    Returns the same (score, move, depth) tuple as ab_move, and stops
+    under the same conditions.
+    """
+    if board.check_win() != None:
+        return SCORES[board.check_win()], (-1, -1), 0
+
+    if time_budget == None:
+        deadline = None
+    else:
+        deadline = time.time() + time_budget
+
+    moves = order_moves(board, board.get_empty_squares())
+    if max_depth == None:
+        max_depth = len(moves)
+    result = (evaluate(board), moves[0], 0)
+
+    pool = get_pool(workers)
+    search = next_search()
+    try:
+        for depth in range(1, max_depth + 1):
+            pending = [pool.apply_async(score_root_move,
+                                        (board, player, move, depth - 1,
+                                         deadline, search))
+                       for move in moves]
+            scores = [task.get() for task in pending]
+            if None in scores:
+                # keep the result of the last depth that was fully searched
+                break
+
+            # the first move with the best score, as ab_move picks it
+            best_score, best_move = None, None
+            truncated = False
+            for move, (score, move_truncated) in zip(moves, scores):
+                if best_move == None or score * SCORES[player] > best_score * SCORES[player]:
+                    best_score, best_move = score, move
+                truncated = truncated or move_truncated
+
+            result = (best_score, best_move, depth)
+            # search the best move first on the next, deeper iteration
+            moves.remove(best_move)
+            moves.insert(0, best_move)
+            if not truncated or abs(best_score) == 1:
+                break
+    finally:
+        next_search()
+
+    return result
+
+
+# Shared between calls so positions scored on earlier moves are reused
+TABLE = TranspositionTable()
+
+def move_wrapper(board, player, trials, time_budget = TIME_BUDGET,
+                 workers = WORKERS):
     """
     Wrapper to allow the use of the same infrastructure that was used
     for Monte Carlo Tic-Tac-Toe.
+
+    With a time_budget in seconds the move comes from ab_move and is
+    returned before the budget runs out.  With more than one worker the
+    root moves of either search are split across a process pool.
     """
-    move = mm_move(board, player)
+    if USE_BITBOARD:
+        import ttt_bitboard
+        board = ttt_bitboard.from_board(board)
+    if time_budget != None and workers > 1:
+        move = ab_move_parallel(board, player, time_budget, None, workers)
+    elif time_budget != None:
+        move = ab_move(board, player, time_budget)
+    elif workers > 1:
+        move = mm_move_parallel(board, player, workers)
+    else:
+        move = mm_move(board, player, TABLE)
     assert move[1] != (-1, -1), "returned illegal move (-1, -1)"
     return move[1]
 
@@ -12,6 +12,7 @@ import poc_ttt_provided as provided
 NTRIALS = 10         # Number of trials to run
 SCORE_CURRENT = 1.0 # Score for squares played by the current player
 SCORE_OTHER = 1.0   # Score for squares played by the other player
+USE_BITBOARD = False # Run the trials on a ttt_bitboard.BitBoard copy
 
 # Creates a list of tuples that are the indexes of the board 
 def get_cords(board):
@@ -93,6 +94,12 @@ def get_best_move(board, scores):
 
 def mc_move(board, player, trials):
     """ func that gets called when comp is going to move and runs Monte Carlo method on board """
+    if USE_BITBOARD:
+        # trials only need the board interface, so a bitboard with the
+        # same squares and reverse flag is a drop-in.  Imported here so
+        # the player still runs where ttt_bitboard is not available
+        import ttt_bitboard
+        board = ttt_bitboard.from_board(board)
     dim = board.get_dim()
     # Creates a list of lists to serve as a score grid 
     score_grid = [[0 for _ in range(dim)] 
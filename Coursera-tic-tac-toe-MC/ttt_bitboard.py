@@ -0,0 +1,224 @@
+"""
+Bitboard Tic-Tac-Toe board for the Monte Carlo and mini-max players
+"""
+
+import random
+import time
+import poc_ttt_provided as provided
+
+STRMAP = {provided.EMPTY: " ",
+          provided.PLAYERX: "X",
+          provided.PLAYERO: "O"}
+
+# Cache of precomputed masks for each board dimension
+MASKS = {}
+
+def get_masks(dim):
+    """
+    Return a tuple (full_mask, cell_lines, cords) for a dim x dim board.
+
+    Square (row, col) is bit row * dim + col.  cell_lines[idx] is the
+    list of line masks that pass through square idx and cords[idx] is
+    the (row, col) tuple of square idx.
+    """
+    if dim not in MASKS:
+        lines = [[(row, col) for col in range(dim)] for row in range(dim)]
+        lines += [[(row, col) for row in range(dim)] for col in range(dim)]
+        lines.append([(idx, idx) for idx in range(dim)])
+        lines.append([(idx, dim - idx - 1) for idx in range(dim)])
+
+        cell_lines = [[] for dummy_idx in range(dim * dim)]
+        for line in lines:
+            mask = 0
+            for row, col in line:
+                mask |= 1 << (row * dim + col)
+            for row, col in line:
+                cell_lines[row * dim + col].append(mask)
+
+        cords = [(idx // dim, idx % dim) for idx in range(dim * dim)]
+        MASKS[dim] = ((1 << (dim * dim)) - 1, cell_lines, cords)
+    return MASKS[dim]
+
+
+class BitBoard:
+    """
+    Tic-Tac-Toe board with the same interface as poc_ttt_provided.TTTBoard
+    that stores the squares of each player as one integer bitmask.
+
+    The winner is found when a move is made, by checking only the lines
+    through the square that was played, so check_win does not rescan
+    the board.
+    """
+
+    def __init__(self, dim, reverse = False, board = None):
+        self._dim = dim
+        self._reverse = reverse
+        self._full_mask, self._cell_lines, self._cords = get_masks(dim)
+        self._xbits = 0
+        self._obits = 0
+        self._winner = None
+        if board != None:
+            for row in range(dim):
+                for col in range(dim):
+                    if board[row][col] != provided.EMPTY:
+                        self.move(row, col, board[row][col])
+
+    def __str__(self):
+        """
+        Return human readable board, in the same format as TTTBoard
+        """
+        rep = ""
+        for row in range(self._dim):
+            for col in range(self._dim):
+                rep += STRMAP[self.square(row, col)]
+                if col == self._dim - 1:
+                    rep += "\n"
+                else:
+                    rep += " | "
+            if row != self._dim - 1:
+                rep += "-" * (4 * self._dim - 3)
+                rep += "\n"
+        return rep
+
+    def get_dim(self):
+        """
+        Return the dimension of the board
+        """
+        return self._dim
+
+    def square(self, row, col):
+        """
+        Return the status (EMPTY, PLAYERX or PLAYERO) of square (row, col)
+        """
+        bit = 1 << (row * self._dim + col)
+        if self._xbits & bit:
+            return provided.PLAYERX
+        elif self._obits & bit:
+            return provided.PLAYERO
+        return provided.EMPTY
+
+    def get_empty_squares(self):
+        """
+        Return a list of (row, col) tuples for all empty squares
+        """
+        cords = self._cords
+        free = self._full_mask & ~(self._xbits | self._obits)
+        empty = []
+        while free:
+            low_bit = free & -free
+            empty.append(cords[low_bit.bit_length() - 1])
+            free ^= low_bit
+        return empty
+
+    def move(self, row, col, player):
+        """
+        Place player on square (row, col), does nothing if the square
+        is not empty
+        """
+        idx = row * self._dim + col
+        bit = 1 << idx
+        if (self._xbits | self._obits) & bit:
+            return
+        if player == provided.PLAYERX:
+            self._xbits |= bit
+            bits = self._xbits
+        else:
+            self._obits |= bit
+            bits = self._obits
+
+        if self._winner == None:
+            for mask in self._cell_lines[idx]:
+                if bits & mask == mask:
+                    if self._reverse:
+                        self._winner = provided.switch_player(player)
+                    else:
+                        self._winner = player
+                    break
+
+    def check_win(self):
+        """
+        Return PLAYERX or PLAYERO for a won board, DRAW for a full board
+        and None if the game is not over
+        """
+        if self._winner != None:
+            return self._winner
+        if self._xbits | self._obits == self._full_mask:
+            return provided.DRAW
+        return None
+
+    def clone(self):
+        """
+        Return a copy of the board
+        """
+        board = BitBoard(self._dim, self._reverse)
+        board._xbits = self._xbits
+        board._obits = self._obits
+        board._winner = self._winner
+        return board
+
+
+def from_board(board, reverse = None):
+    """
+    Return a BitBoard with the same squares as board, which can be any
+    object with get_dim and square methods such as a TTTBoard.
+
+    reverse None keeps the reverse flag of board, so a reverse game is
+    still scored as one.  TTTBoard has no getter for the flag, so it is
+    read from its _reverse attribute.
+    """
+    if reverse == None:
+        reverse = getattr(board, "_reverse", False)
+    dim = board.get_dim()
+    squares = [[board.square(row, col) for col in range(dim)]
+               for row in range(dim)]
+    return BitBoard(dim, reverse, squares)
+
+
+# Benchmark of node throughput against the provided board class
+
+def playout(board, player):
+    """
+    Play random moves on board until the game is over
+    """
+    while board.check_win() == None:
+        row, col = random.choice(board.get_empty_squares())
+        board.move(row, col, player)
+        player = provided.switch_player(player)
+
+
+def count_nodes(board, player, depth):
+    """
+    Visit every board reachable in at most depth moves the way mini-max
+    does and return the number of boards visited
+    """
+    if depth == 0 or board.check_win() != None:
+        return 1
+    nodes = 1
+    for row, col in board.get_empty_squares():
+        board_copy = board.clone()
+        board_copy.move(row, col, player)
+        nodes += count_nodes(board_copy, provided.switch_player(player),
+                             depth - 1)
+    return nodes
+
+
+def run_benchmark(dim = 3, trials = 5000, depth = 6):
+    """
+    Print random playouts per second and mini-max style nodes per
+    second for TTTBoard and BitBoard
+    """
+    for name, board in [("TTTBoard", provided.TTTBoard(dim)),
+                        ("BitBoard", BitBoard(dim))]:
+        start = time.time()
+        for dummy_trial in range(trials):
+            playout(board.clone(), provided.PLAYERX)
+        playout_rate = trials / (time.time() - start)
+
+        start = time.time()
+        nodes = count_nodes(board, provided.PLAYERX, depth)
+        node_rate = nodes / (time.time() - start)
+
+        print name, "dim", dim, ":", int(playout_rate), "playouts/s,",
+        print int(node_rate), "nodes/s"
+
+#run_benchmark()
@@ -1,12 +1,40 @@
 """
 Planner for Yahtzee
 Simplifications:  only allow discard and roll, only score against upper level
+TurnPlanner lifts the first simplification and plans all three rolls of a turn
 """
 
+import collections
+import itertools
+import json
+import mmap
+import random
+import struct
+import time
+
+try:
+    import numpy
+except ImportError:
+    # CodeSkulptor has no NumPy, only the batched scoring needs it
+    numpy = None
+
 # Used to increase the timeout, if necessary
 import codeskulptor
 codeskulptor.set_timeout(20)
 
+# Strategy table file layout: a header of (magic, num_dice, num_die_sides)
+# followed by one (expected score, hold bitmask) record per sorted hand
+TABLE_MAGIC = 0x59415448
+TABLE_HEADER = struct.Struct("<III")
+TABLE_RECORD = struct.Struct("<dI")
+
+# Expected values already computed, keyed on (held_dice, num_die_sides,
+# num_free_dice) with held_dice sorted
+EV_CACHE = {}
+
+# Rolls in a full Yahtzee turn: the first roll and up to two rerolls
+NUM_ROLLS = 3
+
 
 def gen_all_sequences(outcomes, length):
     """
@@ -26,6 +54,26 @@ def gen_all_sequences(outcomes, length):
     return answer_set
 
 
+def gen_sorted_sequences(outcomes, length):
+    """
+    Generator that enumerates each sorted sequence of outcomes of given
+    length once, together with the number of ordered sequences that
+    are permutations of it.
+
+    Yields tuples (sequence, count)
+    """
+    factorials = [1]
+    for num in range(1, length + 1):
+        factorials.append(factorials[-1] * num)
+
+    for sequence in itertools.combinations_with_replacement(sorted(outcomes), length):
+        # multinomial coefficient length! / (k1! * k2! * ...)
+        count = factorials[length]
+        for dummy_item, group in itertools.groupby(sequence):
+            count //= factorials[len(list(group))]
+        yield sequence, count
+
+
 def score(hand):
     """
     Compute the maximal score for a Yahtzee hand according to the
@@ -73,6 +121,76 @@ def expected_value(held_dice, num_die_sides, num_free_dice):
     return final_score         
 
 
+def expected_value_multiset(held_dice, num_die_sides, num_free_dice):
+    """
+    Same result as expected_value, but each distinct sorted roll is
+    scored once and weighted by the number of ordered rolls it stands
+    for, so C(n + s - 1, n) hands are scored instead of s ** n.
+
+    Returns a floating point expected value
+    """
+    list_of_outcomes = list(range(1, num_die_sides + 1))
+    total_score = 0
+    for roll, count in gen_sorted_sequences(list_of_outcomes, num_free_dice):
+        total_score += count * score(held_dice + roll)
+    return float(total_score) / num_die_sides ** num_free_dice
+
+
+
+def score_batch(hands, num_die_sides):
+    """
+    Vectorized score for many hands at once.
+
+    hands: 2D array like with one hand per row, all of the same length
+    num_die_sides: number of sides on each die
+
+    Returns a NumPy integer array with the score of each row
+    """
+    assert numpy != None, "batched scoring needs NumPy"
+    hands = numpy.asarray(hands, dtype = numpy.int64)
+    num_hands = hands.shape[0]
+    if hands.size == 0:
+        return numpy.zeros(num_hands, dtype = numpy.int64)
+    # an out of range value would be counted in the next row's bins
+    assert hands.min() >= 1 and hands.max() <= num_die_sides, \
+        "die values must be between 1 and num_die_sides"
+
+    # count each value per row with one bincount over row-offset values
+    width = num_die_sides + 1
+    offsets = numpy.arange(num_hands, dtype = numpy.int64)[:, None] * width
+    counts = numpy.bincount((hands + offsets).ravel(), minlength = num_hands * width)
+    counts = counts.reshape((num_hands, width))
+    return (counts * numpy.arange(width)).max(axis = 1)
+
+
+def roll_matrix(num_die_sides, num_free_dice):
+    """
+    Return the sorted rolls of num_free_dice dice as rows of a 2D NumPy
+    array, and the number of ordered rolls each row stands for
+    """
+    list_of_outcomes = list(range(1, num_die_sides + 1))
+    rolls = []
+    counts = []
+    for roll, count in gen_sorted_sequences(list_of_outcomes, num_free_dice):
+        rolls.append(roll)
+        counts.append(count)
+    return (numpy.array(rolls, dtype = numpy.int64).reshape((len(rolls), num_free_dice)),
+            numpy.array(counts, dtype = numpy.int64))
+
+
+def expected_value_batch(held_dice, num_die_sides, num_free_dice):
+    """
+    Same result as expected_value, scoring all distinct rolls with one
+    call to score_batch.
+
+    Returns a floating point expected value
+    """
+    rolls, counts = roll_matrix(num_die_sides, num_free_dice)
+    held = numpy.array([held_dice] * len(rolls), dtype = numpy.int64)
+    held = held.reshape((len(rolls), len(held_dice)))
+    scores = score_batch(numpy.hstack((held, rolls)), num_die_sides)
+    return float((counts * scores).sum()) / num_die_sides ** num_free_dice
+
 
 def gen_all_holds(hand):
     """
@@ -95,30 +213,441 @@ def gen_all_holds(hand):
     return output_set
 
 
-def strategy(hand, num_die_sides):
+def iter_distinct_holds(hand):
+    """
+    Generator that yields each distinct choice of dice from hand to
+    hold exactly once, as a sorted tuple.
+
+    Holds are counted out directly from how many dice of each value
+    are in hand, like an odometer, so no list of subsets is built.
+    """
+    values = []
+    counts = []
+    for value, group in itertools.groupby(sorted(hand)):
+        values.append(value)
+        counts.append(len(list(group)))
+
+    taken = [0] * len(values)
+    while True:
+        yield tuple(value for value, num in zip(values, taken)
+                    for dummy_idx in range(num))
+        idx = 0
+        while idx < len(values) and taken[idx] == counts[idx]:
+            taken[idx] = 0
+            idx += 1
+        if idx == len(values):
+            return
+        taken[idx] += 1
+
+
+def strategy(hand, num_die_sides, expected_value_func = expected_value,
+             gen_holds_func = gen_all_holds):
     """
     Compute the hold that maximizes the expected value when the
     discarded dice are rolled.
 
     hand: full yahtzee hand
     num_die_sides: number of sides on each die
+    expected_value_func: function used to compute expected values, such
+    as expected_value or expected_value_multiset
+    gen_holds_func: function that returns or yields the holds to try,
+    such as gen_all_holds or iter_distinct_holds
 
     Returns a tuple where the first element is the expected score and
     the second element is a tuple of the dice to hold
     """
-    all_holds = gen_all_holds(hand)
+    all_holds = gen_holds_func(hand)
     
     output = (0.0, ())
     current_value = 0 
     
     for dice_held in all_holds: 
-        temp = expected_value(dice_held, num_die_sides, len(hand) - len(dice_held)) 
+        temp = expected_value_func(dice_held, num_die_sides, len(hand) - len(dice_held)) 
         if temp > current_value:
             current_value = temp 
             output = (temp, dice_held)
     return output 
 
 
+def strategy_batch(hand, num_die_sides):
+    """
+    Same as strategy, but the holds that leave the same number of dice
+    to roll are scored together, as one score_batch call over every
+    (hold, roll) pair.
+
+    Returns a tuple where the first element is the expected score and
+    the second element is a tuple of the dice to hold
+    """
+    holds_by_size = {}
+    for dice_held in iter_distinct_holds(hand):
+        holds_by_size.setdefault(len(dice_held), []).append(dice_held)
+
+    output = (0.0, ())
+    current_value = 0
+    for size, holds in sorted(holds_by_size.items()):
+        num_free_dice = len(hand) - size
+        rolls, counts = roll_matrix(num_die_sides, num_free_dice)
+        held = numpy.array(holds, dtype = numpy.int64).reshape((len(holds), size))
+
+        # every hold joined with every roll: shape (holds, rolls, dice)
+        hands = numpy.concatenate(
+            (numpy.repeat(held[:, None, :], len(rolls), axis = 1),
+             numpy.repeat(rolls[None, :, :], len(holds), axis = 0)), axis = 2)
+        scores = score_batch(hands.reshape((len(holds) * len(rolls), len(hand))),
+                             num_die_sides)
+        totals = (scores.reshape((len(holds), len(rolls))) * counts).sum(axis = 1)
+
+        best = int(totals.argmax())
+        temp = float(totals[best]) / num_die_sides ** num_free_dice
+        if temp > current_value:
+            current_value = temp
+            output = (temp, holds[best])
+    return output
+
+
+def expected_value_memo(held_dice, num_die_sides, num_free_dice):
+    """
+    Memoized expected_value_multiset.  The expected value only depends
+    on which dice are held, not their order, so sorted holds share
+    one EV_CACHE entry.
+
+    Returns a floating point expected value
+    """
+    key = (tuple(sorted(held_dice)), num_die_sides, num_free_dice)
+    if key not in EV_CACHE:
+        EV_CACHE[key] = expected_value_multiset(key[0], num_die_sides, num_free_dice)
+    return EV_CACHE[key]
+
+
+def build_strategy_table(num_dice, num_die_sides, filename):
+    """
+    Compute the best hold for every sorted hand of num_dice dice and
+    save them to filename in the StrategyTable format.
+    """
+    outcomes = list(range(1, num_die_sides + 1))
+    table_file = open(filename, "wb")
+    try:
+        table_file.write(TABLE_HEADER.pack(TABLE_MAGIC, num_dice, num_die_sides))
+        for hand in itertools.combinations_with_replacement(outcomes, num_dice):
+            hand_score, hold = strategy(hand, num_die_sides, expected_value_memo)
+            # bit idx of the mask is set when hand[idx] is held
+            mask = 0
+            remaining = list(hold)
+            for idx, item in enumerate(hand):
+                if item in remaining:
+                    remaining.remove(item)
+                    mask |= 1 << idx
+            table_file.write(TABLE_RECORD.pack(hand_score, mask))
+    finally:
+        table_file.close()
+
+
+class StrategyTable:
+    """
+    Best holds for every hand, read from a file written by
+    build_strategy_table.  The file is memory-mapped on the first
+    lookup, so a query is one record read.
+    """
+
+    def __init__(self, filename):
+        self._filename = filename
+        self._data = None
+        self._index = None
+        self._num_dice = None
+        self._num_die_sides = None
+
+    def _load(self):
+        """
+        Map the table file and index its records by sorted hand
+        """
+        table_file = open(self._filename, "rb")
+        try:
+            self._data = mmap.mmap(table_file.fileno(), 0, access = mmap.ACCESS_READ)
+        finally:
+            table_file.close()
+        magic, self._num_dice, self._num_die_sides = \
+            TABLE_HEADER.unpack_from(self._data, 0)
+        assert magic == TABLE_MAGIC, "not a strategy table: " + self._filename
+
+        outcomes = list(range(1, self._num_die_sides + 1))
+        hands = itertools.combinations_with_replacement(outcomes, self._num_dice)
+        self._index = dict((hand, idx) for idx, hand in enumerate(hands))
+
+    def lookup(self, hand):
+        """
+        Return the same (expected score, dice to hold) tuple as strategy
+        for hand, with the held dice in sorted order
+        """
+        if self._data == None:
+            self._load()
+        hand = tuple(sorted(hand))
+        offset = TABLE_HEADER.size + self._index[hand] * TABLE_RECORD.size
+        hand_score, mask = TABLE_RECORD.unpack_from(self._data, offset)
+        hold = tuple(item for idx, item in enumerate(hand) if mask & (1 << idx))
+        return hand_score, hold
+
+
+class TurnPlanner:
+    """
+    Optimal holds for a full Yahtzee turn, found by backward induction.
+
+    The value of a hand with no rerolls left is its score.  With k
+    rerolls left it is the best, over all holds, of the expected value
+    of the hand after rerolling the other dice with k - 1 rerolls left.
+    Hand and hold values are cached per stage and shared by every
+    branch that reaches them.
+    """
+
+    def __init__(self, num_die_sides):
+        self._num_die_sides = num_die_sides
+        self._outcomes = list(range(1, num_die_sides + 1))
+        self._hand_values = {}
+        self._hold_values = {}
+
+    def hold_value(self, held_dice, num_free_dice, rerolls_left):
+        """
+        Return the expected final score when held_dice are kept, the
+        num_free_dice others are rolled and rerolls_left rerolls remain
+        after that roll
+        """
+        if rerolls_left == 0:
+            # last roll of the turn, the hand is scored as it lands
+            return expected_value_memo(held_dice, self._num_die_sides, num_free_dice)
+
+        key = (tuple(sorted(held_dice)), num_free_dice, rerolls_left)
+        if key not in self._hold_values:
+            total_value = 0.0
+            for roll, count in gen_sorted_sequences(self._outcomes, num_free_dice):
+                total_value += count * self.plan(key[0] + roll, rerolls_left)[0]
+            self._hold_values[key] = total_value / self._num_die_sides ** num_free_dice
+        return self._hold_values[key]
+
+    def plan(self, hand, rerolls_left = NUM_ROLLS - 1):
+        """
+        Compute the best hold for hand with rerolls_left rerolls left
+        in the turn.
+
+        Returns a tuple where the first element is the expected final
+        score and the second element is a tuple of the dice to hold,
+        which is the whole hand when no rerolls are left
+        """
+        hand = tuple(sorted(hand))
+        key = (hand, rerolls_left)
+        if key not in self._hand_values:
+            if rerolls_left == 0:
+                output = (float(score(hand)), hand)
+            else:
+                output = (-1.0, ())
+                for dice_held in iter_distinct_holds(hand):
+                    temp = self.hold_value(dice_held, len(hand) - len(dice_held),
+                                           rerolls_left - 1)
+                    if temp > output[0]:
+                        output = (temp, dice_held)
+            self._hand_values[key] = output
+        return self._hand_values[key]
+
+
+# Planners already built, keyed on number of die sides
+PLANNERS = {}
+
+def plan_turn(hand, num_die_sides, rerolls_left = NUM_ROLLS - 1):
+    """
+    Compute the hold that maximizes the expected final score of a turn
+    in which rerolls_left rerolls remain, reusing stage values from
+    earlier queries with the same number of die sides.
+
+    Returns a tuple where the first element is the expected score and
+    the second element is a tuple of the dice to hold
+    """
+    if num_die_sides not in PLANNERS:
+        PLANNERS[num_die_sides] = TurnPlanner(num_die_sides)
+    return PLANNERS[num_die_sides].plan(hand, rerolls_left)
+
+
+# Scaling benchmarks of the reference functions and alternative engines
+
+# Each entry is (function, engine, run, normalize): run(hand, held_dice,
+# num_die_sides) calls the engine and normalize turns its result into a
+# value that can be compared with the reference engine of the function.
+# Names are looked up when run is called, so counting wrappers see them.
+BENCHMARK_ENGINES = [
+    ("gen_all_sequences", "reference",
+     lambda hand, held, sides: gen_all_sequences(list(range(1, sides + 1)), len(hand)),
+     lambda result: sorted(collections.Counter(tuple(sorted(seq)) for seq in result).items())),
+    ("gen_all_sequences", "multiset",
+     lambda hand, held, sides: list(gen_sorted_sequences(list(range(1, sides + 1)), len(hand))),
+     sorted),
+    ("expected_value", "reference",
+     lambda hand, held, sides: expected_value(held, sides, len(hand) - len(held)),
+     None),
+    ("expected_value", "multiset",
+     lambda hand, held, sides: expected_value_multiset(held, sides, len(hand) - len(held)),
+     None),
+    ("expected_value", "batch",
+     lambda hand, held, sides: expected_value_batch(held, sides, len(hand) - len(held)),
+     None),
+    ("gen_all_holds", "reference",
+     lambda hand, held, sides: gen_all_holds(hand),
+     lambda result: sorted(set(tuple(sorted(hold)) for hold in result))),
+    ("gen_all_holds", "streaming",
+     lambda hand, held, sides: list(iter_distinct_holds(hand)),
+     sorted),
+    ("strategy", "reference",
+     lambda hand, held, sides: strategy(hand, sides, expected_value, gen_all_holds),
+     lambda result: result[0]),
+    ("strategy", "memo",
+     lambda hand, held, sides: strategy(hand, sides, expected_value_memo, iter_distinct_holds),
+     lambda result: result[0]),
+    ("strategy", "batch",
+     lambda hand, held, sides: strategy_batch(hand, sides),
+     lambda result: result[0]),
+]
+
+# Functions whose calls are counted while an engine runs
+COUNTED_FUNCTIONS = ["score", "score_batch", "gen_all_sequences",
+                     "gen_sorted_sequences", "expected_value",
+                     "expected_value_multiset", "expected_value_batch",
+                     "expected_value_memo", "gen_all_holds",
+                     "iter_distinct_holds"]
+
+
+def benchmark_inputs(num_dice, num_die_sides):
+    """
+    Return the (hand, held_dice) used for a sweep point, drawn from a
+    random generator seeded by the sweep point so runs are reproducible
+    """
+    rng = random.Random(num_dice * 1000 + num_die_sides)
+    hand = tuple(sorted(rng.randint(1, num_die_sides) for dummy_idx in range(num_dice)))
+    return hand, hand[:num_dice // 2]
+
+
+def run_benchmark_case(engine_idx, num_dice, num_die_sides, repeat):
+    """
+    Time one engine at one sweep point and count the calls it makes.
+
+    Returns a tuple (wall time, call counts, normalized result)
+    """
+    dummy_function, dummy_engine, run, normalize = BENCHMARK_ENGINES[engine_idx]
+    hand, held = benchmark_inputs(num_dice, num_die_sides)
+
+    calls = dict((name, 0) for name in COUNTED_FUNCTIONS)
+    originals = dict((name, globals()[name]) for name in COUNTED_FUNCTIONS)
+
+    def make_counter(name):
+        """
+        Return a wrapper of function name that counts its calls
+        """
+        def counter(*args):
+            """ counting wrapper """
+            calls[name] += 1
+            return originals[name](*args)
+        return counter
+
+    EV_CACHE.clear()
+    globals().update((name, make_counter(name)) for name in COUNTED_FUNCTIONS)
+    try:
+        result = run(hand, held, num_die_sides)
+    finally:
+        globals().update(originals)
+
+    # time without the counting wrappers, best of repeat runs
+    wall_time = None
+    for dummy_run in range(repeat):
+        EV_CACHE.clear()
+        start = time.time()
+        run(hand, held, num_die_sides)
+        elapsed = time.time() - start
+        if wall_time == None or elapsed < wall_time:
+            wall_time = elapsed
+
+    if normalize != None:
+        result = normalize(result)
+    calls = dict((name, count) for name, count in calls.items() if count > 0)
+    return wall_time, calls, result
+
+
+def measure_benchmark_memory(engine_idx, num_dice, num_die_sides):
+    """
+    Run one engine once at one sweep point, without the counting
+    wrappers.  Meant to run in a fresh worker process, so that its peak
+    resident set size belongs to this engine alone.
+
+    Returns a tuple (peak RSS in KB before the run, peak RSS in KB after
+    the run), as reported by ru_maxrss on Linux
+    """
+    import resource
+
+    run = BENCHMARK_ENGINES[engine_idx][2]
+    hand, held = benchmark_inputs(num_dice, num_die_sides)
+
+    EV_CACHE.clear()
+    base_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    run(hand, held, num_die_sides)
+    return base_kb, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_in_fresh_worker(function, args):
+    """
+    Return function(*args) computed in a new single worker process
+    """
+    import multiprocessing
+
+    pool = multiprocessing.Pool(1)
+    try:
+        return pool.apply(function, args)
+    finally:
+        pool.terminate()
+
+
+def run_benchmarks(dice_counts = (1, 2, 3, 4, 5), side_counts = (4, 6, 8),
+                   repeat = 3, filename = None):
+    """
+    Sweep every engine in BENCHMARK_ENGINES over (num_dice, num_die_sides)
+    and compare each one with the reference engine of its function.
+
+    Returns a list of result dictionaries, which are also saved to
+    filename as JSON if it is given.
+    """
+    results = []
+    for num_dice in dice_counts:
+        for num_die_sides in side_counts:
+            reference = {}
+            for engine_idx, entry in enumerate(BENCHMARK_ENGINES):
+                function, engine = entry[0], entry[1]
+                if engine == "batch" and numpy == None:
+                    continue
+                case = (engine_idx, num_dice, num_die_sides)
+                wall_time, calls, result = run_in_fresh_worker(
+                    run_benchmark_case, case + (repeat,))
+                # memory is measured in its own worker, away from the
+                # counting wrappers and the timing repeats
+                base_kb, peak_kb = run_in_fresh_worker(
+                    measure_benchmark_memory, case)
+
+                if engine == "reference":
+                    reference[function] = (wall_time, result)
+                ref_time, ref_result = reference[function]
+                row = {"function": function, "engine": engine,
+                       "num_dice": num_dice, "num_die_sides": num_die_sides,
+                       "wall_time": wall_time, "base_rss_kb": base_kb,
+                       "peak_rss_kb": peak_kb, "calls": calls,
+                       "speedup": ref_time / max(wall_time, 1e-9),
+                       "matches_reference": result == ref_result}
+                results.append(row)
+                print function, engine, num_dice, "dice", num_die_sides, "sides:",
+                print "%.6fs" % wall_time, "x%.1f" % row["speedup"],
+                print "peak RSS", peak_kb, "KB (base", base_kb, "KB)",
+                print calls, "ok" if row["matches_reference"] else "MISMATCH"
+
+    if filename != None:
+        out_file = open(filename, "w")
+        try:
+            json.dump(results, out_file, indent = 1, sort_keys = True)
+        finally:
+            out_file.close()
+    return results
+
+
 def run_example():
     """
     Compute the dice to hold and expected score for an example hand
@@ -132,6 +661,8 @@ def run_example():
 run_example()
 
 
+#run_benchmarks(filename = "yahtzee_benchmarks.json")
+
 #import poc_holds_testsuite
 #poc_holds_testsuite.run_suite(gen_all_holds)
                                        
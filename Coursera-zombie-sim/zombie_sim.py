@@ -2,11 +2,21 @@
 Student portion of Zombie Apocalypse mini-project
 """
 
+import array
+import collections
+import heapq
 import random
+import time
 import poc_grid
 import poc_queue
 import poc_zombie_gui
 
+try:
+    import numpy
+except ImportError:
+    # CodeSkulptor has no NumPy, only the vectorized engine needs it
+    numpy = None
+
 # global constants
 EMPTY = 0 
 FULL = 1
@@ -16,6 +26,157 @@ OBSTACLE = 5
 HUMAN = 6
 ZOMBIE = 7
 
+# Side length of the square tiles of a ChunkedGrid
+CHUNK_SIZE = 64
+
+
+class EntityStore:
+    """
+    Compact store of entity positions, kept in the order the entities
+    were added.  Rows and columns are stored in integer arrays indexed
+    by entity, and an occupancy map counts the entities on each cell.
+    """
+
+    def __init__(self, cells = None):
+        """
+        Create a store holding the (row, col) tuples in cells
+        """
+        self._rows = array.array('l')
+        self._cols = array.array('l')
+        self._occupancy = {}
+        if cells != None:
+            for cell in cells:
+                self.append(cell[0], cell[1])
+
+    def __len__(self):
+        """
+        Return number of entities
+        """
+        return len(self._rows)
+
+    def __iter__(self):
+        """
+        Yield the (row, col) position of each entity in order
+        """
+        rows = self._rows
+        cols = self._cols
+        for idx in range(len(rows)):
+            yield (rows[idx], cols[idx])
+
+    def __getitem__(self, idx):
+        """
+        Return the (row, col) position of entity idx
+        """
+        return (self._rows[idx], self._cols[idx])
+
+    def append(self, row, col):
+        """
+        Add an entity at (row, col)
+        """
+        self._rows.append(row)
+        self._cols.append(col)
+        self._occupancy[(row, col)] = self._occupancy.get((row, col), 0) + 1
+
+    def move(self, idx, row, col):
+        """
+        Move entity idx to (row, col)
+        """
+        old_cell = (self._rows[idx], self._cols[idx])
+        if self._occupancy[old_cell] == 1:
+            del self._occupancy[old_cell]
+        else:
+            self._occupancy[old_cell] -= 1
+        self._rows[idx] = row
+        self._cols[idx] = col
+        self._occupancy[(row, col)] = self._occupancy.get((row, col), 0) + 1
+
+    def count_at(self, row, col):
+        """
+        Return number of entities on cell (row, col)
+        """
+        return self._occupancy.get((row, col), 0)
+
+    def occupancy(self):
+        """
+        Return a dictionary mapping each occupied cell to the number of
+        entities on it
+        """
+        return dict(self._occupancy)
+
+
+class ChunkedGrid:
+    """
+    Grid of integer values stored in square tiles that are only
+    allocated once a cell in them is set to a non-default value, so
+    memory use follows the part of the grid that is actually used.
+    """
+
+    def __init__(self, default, chunk_size = CHUNK_SIZE):
+        """
+        Create a grid with every cell set to default
+        """
+        self._default = default
+        self._chunk_size = chunk_size
+        self._chunks = {}
+
+    def __getitem__(self, row):
+        """
+        Return a view of row, so cells can be used as grid[row][col]
+        """
+        return ChunkedRow(self, row)
+
+    def get(self, row, col):
+        """
+        Return the value of cell (row, col)
+        """
+        size = self._chunk_size
+        chunk = self._chunks.get((row // size, col // size))
+        if chunk == None:
+            return self._default
+        return chunk[(row % size) * size + col % size]
+
+    def set(self, row, col, value):
+        """
+        Set the value of cell (row, col), allocating its tile if needed
+        """
+        size = self._chunk_size
+        key = (row // size, col // size)
+        chunk = self._chunks.get(key)
+        if chunk == None:
+            if value == self._default:
+                return
+            chunk = array.array('l', [self._default]) * (size * size)
+            self._chunks[key] = chunk
+        chunk[(row % size) * size + col % size] = value
+
+    def num_chunks(self):
+        """
+        Return number of allocated tiles
+        """
+        return len(self._chunks)
+
+    def clear(self):
+        """
+        Reset every cell to the default value and free all tiles
+        """
+        self._chunks = {}
+
+
+class ChunkedRow:
+    """
+    View of one row of a ChunkedGrid
+    """
+
+    def __init__(self, grid, row):
+        self._grid = grid
+        self._row = row
+
+    def __getitem__(self, col):
+        return self._grid.get(self._row, col)
+
+    def __setitem__(self, col, value):
+        self._grid.set(self._row, col, value)
+
 
 class Apocalypse(poc_grid.Grid):
     """
@@ -24,38 +185,116 @@ class Apocalypse(poc_grid.Grid):
     """
 
     def __init__(self, grid_height, grid_width, obstacle_list = None, 
-                 zombie_list = None, human_list = None):
+                 zombie_list = None, human_list = None, sparse = False):
         """
         Create a simulation of given size with given obstacles,
         humans, and zombies
+
+        A sparse simulation keeps obstacles and distance fields in
+        ChunkedGrids instead of lists of lists, for very large maps
+        that are mostly empty.
         """
-        poc_grid.Grid.__init__(self, grid_height, grid_width)
+        if sparse:
+            self._grid_height = grid_height
+            self._grid_width = grid_width
+            self._cells = None
+            self._obstacle_chunks = ChunkedGrid(EMPTY)
+        else:
+            poc_grid.Grid.__init__(self, grid_height, grid_width)
+            self._obstacle_chunks = None
+        self._obstacle_array = None
+        self._costs = {}
+        self.set_incremental(False)
         if obstacle_list != None:
             for cell in obstacle_list:
                 self.set_full(cell[0], cell[1])
-        if zombie_list != None:
-            self._zombie_list = list(zombie_list)
-        else:
-            self._zombie_list = []
-        if human_list != None:
-            self._human_list = list(human_list)  
-        else:
-            self._human_list = []
+        self._zombie_list = EntityStore(zombie_list)
+        self._human_list = EntityStore(human_list)
         
     def clear(self):
         """
         Set cells in obstacle grid to be empty
         Reset zombie and human lists to be empty
         """
-        self._zombie_list = []
-        self._human_list = [] 
-        poc_grid.Grid.clear(self)       
+        self._zombie_list = EntityStore()
+        self._human_list = EntityStore()
+        if self._obstacle_chunks != None:
+            self._obstacle_chunks.clear()
+        else:
+            poc_grid.Grid.clear(self)       
+        self._obstacle_array = None
+        self._costs = {}
+        self.set_incremental(self._incremental)
+
+    def set_empty(self, row, col):
+        """
+        Set cell with index (row, col) to be empty
+        """
+        if self._obstacle_chunks != None:
+            self._obstacle_chunks.set(row, col, EMPTY)
+        else:
+            poc_grid.Grid.set_empty(self, row, col)
+        self._obstacle_array = None
+        for changed_cells in self._changed_cells.values():
+            changed_cells.add((row, col))
+
+    def set_full(self, row, col):
+        """
+        Set cell with index (row, col) to be full
+        """
+        if self._obstacle_chunks != None:
+            self._obstacle_chunks.set(row, col, FULL)
+        else:
+            poc_grid.Grid.set_full(self, row, col)
+        self._obstacle_array = None
+        for changed_cells in self._changed_cells.values():
+            changed_cells.add((row, col))
+
+    def is_empty(self, row, col):
+        """
+        Checks whether cell with index (row, col) is empty
+        """
+        if self._obstacle_chunks != None:
+            return self._obstacle_chunks.get(row, col) == EMPTY
+        return poc_grid.Grid.is_empty(self, row, col)
+
+    def set_cost(self, row, col, cost):
+        """
+        Set the integer cost of moving into cell (row, col), such as a
+        terrain slowdown.  Cells cost 1 unless set otherwise.
+        """
+        assert cost >= 1, "movement costs must be positive integers"
+        if cost == 1:
+            self._costs.pop((row, col), None)
+        else:
+            self._costs[(row, col)] = cost
+
+    def get_cost(self, row, col):
+        """
+        Return the cost of moving into cell (row, col)
+        """
+        return self._costs.get((row, col), 1)
+
+    def set_incremental(self, incremental):
+        """
+        Turn incremental distance fields on or off.
+
+        In incremental mode compute_distance_field keeps the last field
+        for each entity type and only repairs the cells affected by
+        entities or obstacles that changed since the previous call.  The
+        returned field is then shared with later calls and must not be
+        modified by the caller.
+        """
+        self._incremental = incremental
+        self._distance_fields = {}
+        self._field_sources = {}
+        self._changed_cells = {}
         
     def add_zombie(self, row, col):
         """
         Add zombie to the zombie list
         """
-        self._zombie_list.append((row, col))
+        self._zombie_list.append(row, col)
                 
     def num_zombies(self):
         """
@@ -71,11 +310,17 @@ class Apocalypse(poc_grid.Grid):
         for zombie in self._zombie_list: 
             yield zombie
 
+    def num_zombies_at(self, row, col):
+        """
+        Return number of zombies on cell (row, col)
+        """
+        return self._zombie_list.count_at(row, col)
+
     def add_human(self, row, col):
         """
         Add human to the human list
         """
-        self._human_list.append((row, col))
+        self._human_list.append(row, col)
         
     def num_humans(self):
         """
@@ -89,17 +334,40 @@ class Apocalypse(poc_grid.Grid):
         """
         for item in self._human_list: 
             yield item 
+
+    def num_humans_at(self, row, col):
+        """
+        Return number of humans on cell (row, col)
+        """
+        return self._human_list.count_at(row, col)
         
-    def compute_distance_field(self, entity_type):
+    def compute_distance_field(self, entity_type, neighborhood = FOUR_WAY):
         """
         Function computes and returns a 2D distance field
         Distance at member of entity_list is zero
         Shortest paths avoid obstacles and use four-way distances
+
+        With EIGHT_WAY neighborhood or cells with movement costs set,
+        the field holds least total movement costs instead of steps.
+        """
+        if neighborhood != FOUR_WAY or self._costs:
+            return self._weighted_distance_field(entity_type, neighborhood)
+        if self._incremental:
+            return self._repair_distance_field(entity_type)
+        return self._full_distance_field(entity_type)
+
+    def _full_distance_field(self, entity_type):
+        """
+        Compute the distance field for entity_type from scratch with a
+        breadth first search
         """
         if entity_type == ZOMBIE: 
             piece_list = self._zombie_list
         elif entity_type == HUMAN: 
             piece_list = self._human_list 
+
+        if self._obstacle_chunks != None:
+            return self._sparse_distance_field(piece_list)
         
         # creates a new grid object of the same size as board, with empty cells 
         visited = poc_grid.Grid(self._grid_height, self._grid_width) 
@@ -135,6 +403,222 @@ class Apocalypse(poc_grid.Grid):
                     distance_field[nbor[0]][nbor[1]] = distance_field[cell[0]][cell[1]] + 1 
                     
         return distance_field 
+
+    def _sparse_distance_field(self, piece_list):
+        """
+        Breadth first search that stores the distance field in a
+        ChunkedGrid, so only tiles reached by the search are allocated
+        """
+        unreached = self._grid_width * self._grid_height
+        distance_field = ChunkedGrid(unreached)
+        boundry = collections.deque()
+        for row, col in piece_list:
+            if distance_field.get(row, col) != 0:
+                distance_field.set(row, col, 0)
+                boundry.append((row, col))
+
+        while boundry:
+            row, col = boundry.popleft()
+            dist = distance_field.get(row, col) + 1
+            for nbor in self.four_neighbors(row, col):
+                # a cell has been visited once its distance is set
+                if (distance_field.get(nbor[0], nbor[1]) == unreached and
+                        self.is_empty(nbor[0], nbor[1])):
+                    distance_field.set(nbor[0], nbor[1], dist)
+                    boundry.append(nbor)
+
+        return distance_field
+
+    def _weighted_distance_field(self, entity_type, neighborhood):
+        """
+        Dijkstra's algorithm over four-way or eight-way moves, where
+        entering a cell costs get_cost, using a bucket queue (Dial's
+        algorithm) indexed by distance
+        """
+        if entity_type == ZOMBIE: 
+            piece_list = self._zombie_list
+        elif entity_type == HUMAN: 
+            piece_list = self._human_list 
+        if neighborhood == EIGHT_WAY:
+            neighbors = self.eight_neighbors
+        else:
+            neighbors = self.four_neighbors
+
+        # no path costs more than max_cost per cell of the grid
+        max_cost = max([1] + list(self._costs.values()))
+        unreached = self._grid_width * self._grid_height * max_cost
+        if self._obstacle_chunks != None:
+            distance_field = ChunkedGrid(unreached)
+        else:
+            distance_field = [[unreached for dummy_col in range(self._grid_width)]
+                              for dummy_row in range(self._grid_height)]
+
+        # pending cells only span max_cost + 1 distances, so the buckets
+        # are reused in a ring
+        buckets = [[] for dummy_idx in range(max_cost + 1)]
+        pending = 0
+        for row, col in piece_list:
+            distance_field[row][col] = 0
+            buckets[0].append((row, col))
+            pending += 1
+
+        dist = 0
+        while pending > 0:
+            bucket = buckets[dist % (max_cost + 1)]
+            while bucket:
+                row, col = bucket.pop()
+                pending -= 1
+                if distance_field[row][col] != dist:
+                    # stale entry for a cell that was reached more cheaply
+                    continue
+                for nbor in neighbors(row, col):
+                    if not self.is_empty(nbor[0], nbor[1]):
+                        continue
+                    new_dist = dist + self._costs.get(nbor, 1)
+                    if new_dist < distance_field[nbor[0]][nbor[1]]:
+                        distance_field[nbor[0]][nbor[1]] = new_dist
+                        buckets[new_dist % (max_cost + 1)].append(nbor)
+                        pending += 1
+            dist += 1
+
+        return distance_field
+
+    def _repair_distance_field(self, entity_type):
+        """
+        Update the cached distance field for entity_type to match the
+        current entities and obstacles, touching only affected cells
+        """
+        if entity_type == ZOMBIE: 
+            sources = self._zombie_list.occupancy()
+        elif entity_type == HUMAN: 
+            sources = self._human_list.occupancy()
+
+        distance_field = self._distance_fields.get(entity_type)
+        if distance_field == None:
+            distance_field = self._full_distance_field(entity_type)
+            self._distance_fields[entity_type] = distance_field
+            self._field_sources[entity_type] = sources
+            self._changed_cells[entity_type] = set()
+            return distance_field
+
+        old_sources = self._field_sources[entity_type]
+        changed_cells = self._changed_cells[entity_type]
+        self._field_sources[entity_type] = sources
+        self._changed_cells[entity_type] = set()
+        unreached = self._grid_width * self._grid_height
+
+        # cells whose distance may grow: removed entities and new obstacles
+        raised = set(cell for cell in old_sources if cell not in sources)
+        raised.update(cell for cell in changed_cells
+                      if not self.is_empty(cell[0], cell[1]) and cell not in sources)
+        lost = set(cell for cell in raised
+                   if distance_field[cell[0]][cell[1]] < unreached)
+
+        # walk the old shortest paths outwards in order of distance, a cell
+        # is lost when no neighbor one step closer to an entity is kept
+        boundry = [(distance_field[row][col], (row, col)) for row, col in lost]
+        heapq.heapify(boundry)
+        while boundry:
+            dist, cell = heapq.heappop(boundry)
+            for nbor in self.four_neighbors(cell[0], cell[1]):
+                if (nbor in lost or nbor in sources or
+                        distance_field[nbor[0]][nbor[1]] != dist + 1):
+                    continue
+                supported = False
+                for other in self.four_neighbors(nbor[0], nbor[1]):
+                    if distance_field[other[0]][other[1]] == dist and other not in lost:
+                        supported = True
+                        break
+                if not supported:
+                    lost.add(nbor)
+                    heapq.heappush(boundry, (dist + 1, nbor))
+
+        for row, col in lost:
+            distance_field[row][col] = unreached
+
+        # reseed lost cells from their kept neighbors, then add new
+        # entities and cells that stopped being obstacles
+        boundry = []
+        for cell in lost | set(changed_cells):
+            if cell in sources or not self.is_empty(cell[0], cell[1]):
+                continue
+            dist = min([distance_field[nbor[0]][nbor[1]]
+                        for nbor in self.four_neighbors(cell[0], cell[1])] +
+                       [unreached]) + 1
+            if dist < distance_field[cell[0]][cell[1]]:
+                distance_field[cell[0]][cell[1]] = dist
+                heapq.heappush(boundry, (dist, cell))
+        for row, col in sources:
+            if distance_field[row][col] != 0:
+                distance_field[row][col] = 0
+                heapq.heappush(boundry, (0, (row, col)))
+
+        # shrink distances outwards from the reseeded cells
+        while boundry:
+            dist, cell = heapq.heappop(boundry)
+            if dist > distance_field[cell[0]][cell[1]]:
+                continue
+            for nbor in self.four_neighbors(cell[0], cell[1]):
+                if (distance_field[nbor[0]][nbor[1]] > dist + 1 and
+                        self.is_empty(nbor[0], nbor[1])):
+                    distance_field[nbor[0]][nbor[1]] = dist + 1
+                    heapq.heappush(boundry, (dist + 1, nbor))
+
+        return distance_field
+
+    def get_obstacle_array(self):
+        """
+        Return a boolean NumPy array that is True at obstacle cells.
+        The array is cached until the obstacles change.
+        """
+        assert self._obstacle_chunks == None, "sparse grids have no obstacle array"
+        if self._obstacle_array is None:
+            self._obstacle_array = numpy.array(self._cells) != EMPTY
+        return self._obstacle_array
+
+    def compute_distance_field_array(self, entity_type):
+        """
+        Vectorized version of compute_distance_field that returns the
+        distance field as a 2D NumPy array.
+
+        The BFS frontier is kept as an array of flat cell indices and
+        every wavefront is expanded with whole array operations, so each
+        step costs time proportional to the frontier, not the grid.  Use
+        tolist() on the result to get the same list of lists as
+        compute_distance_field.
+        """
+        assert numpy != None, "vectorized distance field needs NumPy"
+        if entity_type == ZOMBIE: 
+            piece_list = self._zombie_list
+        elif entity_type == HUMAN: 
+            piece_list = self._human_list 
+
+        width = self._grid_width
+        size = self._grid_height * width
+        distance_field = numpy.full(size, size, dtype = numpy.int64)
+        visited = self.get_obstacle_array().ravel().copy()
+
+        frontier = numpy.array([row * width + col for row, col in piece_list],
+                               dtype = numpy.int64)
+        frontier = numpy.unique(frontier)
+        distance_field[frontier] = 0
+        visited[frontier] = True
+
+        distance = 0
+        while frontier.size > 0:
+            # cells four-way adjacent to the frontier that are new and open
+            distance += 1
+            cols = frontier % width
+            reached = numpy.concatenate((frontier[frontier >= width] - width,
+                                         frontier[frontier < size - width] + width,
+                                         frontier[cols > 0] - 1,
+                                         frontier[cols < width - 1] + 1))
+            reached = numpy.unique(reached[~visited[reached]])
+            visited[reached] = True
+            distance_field[reached] = distance
+            frontier = reached
+
+        return distance_field.reshape((self._grid_height, width))
     
     def move_humans(self, zombie_distance_field):
         """
@@ -142,7 +626,7 @@ class Apocalypse(poc_grid.Grid):
         are allowed
         """
         # gets a list of neighbors for each human in human list & add current cell  
-        for item in self.humans():
+        for idx, item in enumerate(self.humans()):
             neighbors = self.eight_neighbors(item[0], item[1])
             neighbors.append(item)
             cell_value = 0 
@@ -157,10 +641,9 @@ class Apocalypse(poc_grid.Grid):
                     possible_moves = [cell] 
                 elif cell_value == zom_cell:
                     possible_moves.append(cell) 
-            # chooses move from list, gets index, changes location in human_list   
+            # chooses move from list, changes location of this human in place
             human_move = random.choice(possible_moves) 
-            idx = self._human_list.index(item)          
-            self._human_list[idx] = human_move              
+            self._human_list.move(idx, human_move[0], human_move[1])
     
     def move_zombies(self, human_distance_field):
         """
@@ -168,10 +651,11 @@ class Apocalypse(poc_grid.Grid):
         are allowed
         """
         # gets a list of neighbors for each zombie in zombie list
-        for item in self.zombies():
+        for idx, item in enumerate(self.zombies()):
             neighbors = self.four_neighbors(item[0], item[1])
             neighbors.append(item)
-            cell_value = 1000
+            # start above any distance, fields of large grids exceed 1000
+            cell_value = float("inf")
             possible_moves = []
             
             for cell in neighbors: 
@@ -184,10 +668,97 @@ class Apocalypse(poc_grid.Grid):
                 elif cell_value == hum_cell:
                     possible_moves.append(cell) 
 
-            # chooses move from list, gets index, changes location in zombie_list   
+            # chooses move from list, changes location of this zombie in place
             zombie_move = random.choice(possible_moves) 
-            idx = self._zombie_list.index(item)          
-            self._zombie_list[idx] = zombie_move  
+            self._zombie_list.move(idx, zombie_move[0], zombie_move[1])
+
+    def num_survivors(self):
+        """
+        Return number of humans that do not share a cell with a zombie
+        """
+        return sum(1 for item in self.humans()
+                   if self.num_zombies_at(item[0], item[1]) == 0)
+
+
+# Headless simulation, without the GUI
+
+def random_apocalypse(grid_height, grid_width, num_obstacles,
+                      num_zombies, num_humans):
+    """
+    Return an Apocalypse with obstacles, zombies and humans placed on
+    distinct random cells chosen with the random module
+    """
+    assert num_obstacles + num_zombies + num_humans <= grid_height * grid_width, \
+        "more entities than cells"
+    cells = set()
+    placed = []
+    while len(placed) < num_obstacles + num_zombies + num_humans:
+        cell = (random.randrange(grid_height), random.randrange(grid_width))
+        if cell not in cells:
+            cells.add(cell)
+            placed.append(cell)
+    return Apocalypse(grid_height, grid_width, placed[:num_obstacles],
+                      placed[num_obstacles:num_obstacles + num_zombies],
+                      placed[num_obstacles + num_zombies:])
+
+
+def run_headless(apocalypse, num_ticks):
+    """
+    Run num_ticks steps of the simulation without the GUI.  In each step
+    zombies stalk the humans and then humans flee from the zombies.
+
+    Returns a dictionary with the number of surviving humans after each
+    step under "survivors" and the seconds taken by each step under
+    "step_times", both as compact arrays.
+    """
+    survivors = array.array('l')
+    step_times = array.array('d')
+    for dummy_tick in range(num_ticks):
+        start = time.time()
+        apocalypse.move_zombies(apocalypse.compute_distance_field(HUMAN))
+        apocalypse.move_humans(apocalypse.compute_distance_field(ZOMBIE))
+        step_times.append(time.time() - start)
+        survivors.append(apocalypse.num_survivors())
+    return {"survivors": survivors, "step_times": step_times}
+
+
+def run_seeded(scenario):
+    """
+    Process pool task for run_batch: build and run one seeded scenario
+    given as a tuple (seed, grid_height, grid_width, num_obstacles,
+    num_zombies, num_humans, num_ticks, incremental)
+    """
+    seed, grid_height, grid_width, num_obstacles, num_zombies, \
+        num_humans, num_ticks, incremental = scenario
+    random.seed(seed)
+    apocalypse = random_apocalypse(grid_height, grid_width, num_obstacles,
+                                   num_zombies, num_humans)
+    apocalypse.set_incremental(incremental)
+    stats = run_headless(apocalypse, num_ticks)
+    stats["seed"] = seed
+    return stats
+
+
+def run_batch(seeds, grid_height, grid_width, num_obstacles, num_zombies,
+              num_humans, num_ticks, incremental = False, workers = None):
+    """
+    Run one random scenario per seed in a process pool.
+
+    Each run is reproducible from its seed.  Returns a list with the
+    run_headless statistics of each run, plus its "seed", in the order
+    of seeds.  workers is the size of the pool, None uses one process
+    per CPU.
+    """
+    import multiprocessing
+
+    scenarios = [(seed, grid_height, grid_width, num_obstacles, num_zombies,
+                  num_humans, num_ticks, incremental) for seed in seeds]
+    pool = multiprocessing.Pool(workers)
+    try:
+        return pool.map(run_seeded, scenarios)
+    finally:
+        pool.terminate()
+        pool.join()
 
     
 
@@ -6,13 +6,79 @@ import urllib2
 import codeskulptor
 import poc_wrangler_provided as provided
 
+try:
+    import heapq
+    import mmap
+    import os
+    import pickle
+    import tempfile
+except ImportError:
+    # CodeSkulptor has none of these, only the file based helpers need
+    # them and load_words falls back to the assets url
+    heapq = mmap = os = pickle = tempfile = None
+
 #import user41_cymI9racho_8 as zk 
 
 WORDFILE = "assets_scrabble_words3.txt"
 
+# Anagram index saved next to the word file so restarts skip the build
+INDEXFILE = WORDFILE + ".idx"
+
+# Number of words sorted in memory at a time by external_sort
+RUN_SIZE = 100000
+
+# Most run files external_sort merges, and so keeps open, at once
+MERGE_FAN_IN = 64
+
 
 # Functions to manipulate ordered word lists
 
+# The iter_ functions take any sorted iterables, such as lists or
+# iter_file_words streams, and make a single pass over them, yielding
+# results as they go without building intermediate lists
+
+# Marks the end of an iterator in the iter_ functions
+_END = object()
+
+def iter_file_words(filename):
+    """
+    Lazily yield the words in the file named filename, one per line.
+    """
+    word_file = open(filename)
+    try:
+        for line in word_file:
+            word = line.strip()
+            if word:
+                yield word
+    finally:
+        word_file.close()
+
+def iter_remove_duplicates(iterable1):
+    """
+    Yield the elements of the sorted iterable1 with duplicates removed.
+    """
+    previous = _END
+    for item in iterable1:
+        if previous is _END or item != previous:
+            yield item
+            previous = item
+
+def iter_intersect(iterable1, iterable2):
+    """
+    Yield the elements of the sorted iterable1 that are also in the
+    sorted iterable2, keeping repeats from iterable1.
+    """
+    iter2 = iter(iterable2)
+    item2 = next(iter2, _END)
+    for item in iterable1:
+        # skip past everything in iterable2 that is smaller than item
+        while item2 is not _END and item2 < item:
+            item2 = next(iter2, _END)
+        if item2 is _END:
+            return
+        if item2 == item:
+            yield item
+
 def remove_duplicates(list1):
     """
     Eliminate duplicates in a sorted list.
@@ -22,11 +88,7 @@ def remove_duplicates(list1):
 
     This function can be iterative.
     """
-    output = [] 
-    for item in list1: 
-        if item not in output: 
-            output.append(item) 
-    return output
+    return list(iter_remove_duplicates(list1))
          
 def intersect(list1, list2):
     """
@@ -37,14 +99,39 @@ def intersect(list1, list2):
 
     This function can be iterative.
     """
-    output = []   
-    for item in list1: 
-        if item in list1 and item in list2: 
-            output.append(item)
-    return output
+    return list(iter_intersect(list1, list2))
 
 # Functions to perform merge sort
 
+def iter_merge(iterable1, iterable2):
+    """
+    Yield all of the elements of the sorted iterable1 and iterable2
+    in sorted order.  On ties the element from iterable2 comes first.
+    """
+    iter1 = iter(iterable1)
+    iter2 = iter(iterable2)
+    item1 = next(iter1, _END)
+    item2 = next(iter2, _END)
+    
+    # yield the smaller of the two front elements until one runs out
+    while item1 is not _END and item2 is not _END:
+        if item1 < item2:
+            yield item1
+            item1 = next(iter1, _END)
+        else:
+            yield item2
+            item2 = next(iter2, _END)
+    
+    # then yield whatever is left of the other one 
+    if item1 is not _END:
+        yield item1
+        for item1 in iter1:
+            yield item1
+    if item2 is not _END:
+        yield item2
+        for item2 in iter2:
+            yield item2
+
 def merge(list1, list2):
     """
     Merge two sorted lists.
@@ -54,41 +141,123 @@ def merge(list1, list2):
 
     This function can be iterative.
     """
-    # creates a copy of lists to avoid mutating originals 
-    output = [] 
-    copy1 = list1[:]
-    copy2 = list2[:]
-    
-    # while there is something in copy1/2 pop the smaller element at idx
-    # append the smaller to output 
-    while copy1 and copy2: 
-        if copy1[0] < copy2[0]:
-            output.append(copy1.pop(0))
-        else: 
-            output.append(copy2.pop(0))
-    
-    #once the while loop is over add left over elements from comparison 
-    output += copy1 + copy2 
-    
-    return output
+    return list(iter_merge(list1, list2))
 
-def merge_sort(list1):
+def merge_sort(list1, run_size = None):
     """
     Sort the elements of list1.
 
     Return a new sorted list with the same elements as list1.
 
     This function should be recursive.
+
+    Splits list1 in halves, so the recursion is only log2(len(list1))
+    deep whatever the order of the input.  Lists of strings longer than
+    run_size and without newlines are sorted with external_sort instead.
     """
+    if run_size != None and len(list1) > run_size and \
+       all(isinstance(word, basestring) and "\n" not in word 
+           for word in list1):
+        return list(external_sort(list1, run_size))
     
-    if list1 == []:
-        return list1
+    if len(list1) <= 1:
+        return list1[:]
     else:
-        pivot = list1[0]
-        lesser = [number for number in list1 if number < pivot]
-        pivots = [number for number in list1 if number == pivot]
-        greater = [number for number in list1 if number > pivot]
-        return merge_sort(lesser) + pivots + merge_sort(greater)
+        middle = len(list1) // 2
+        return merge(merge_sort(list1[:middle]), merge_sort(list1[middle:]))
+
+def _write_run(words, temp_dir):
+    """
+    Write the words to a new temporary file in temp_dir, one per line.
+    Returns the name of the file.
+    """
+    handle, filename = tempfile.mkstemp(suffix = ".run", dir = temp_dir)
+    run_file = os.fdopen(handle, "w")
+    try:
+        for word in words:
+            run_file.write(word + "\n")
+    finally:
+        run_file.close()
+    return filename
+
+def _iter_run(filename):
+    """
+    Yield the words of a run file written by _write_run exactly as they
+    were written, including empty ones and surrounding whitespace
+    """
+    run_file = open(filename)
+    try:
+        for line in run_file:
+            yield line[:-1]
+    finally:
+        run_file.close()
+
+def _merge_runs(filenames):
+    """
+    Return a heap merge of the sorted run files in filenames
+    """
+    return heapq.merge(*[_iter_run(filename) for filename in filenames])
+
+def external_sort(iterable1, run_size = RUN_SIZE, dedupe = False, 
+                  temp_dir = None, fan_in = MERGE_FAN_IN):
+    """
+    Yield the words in iterable1 in sorted order, holding at most
+    run_size words in memory.
+
+    Words are sorted in runs of run_size, each run is written to a
+    temporary file in temp_dir and the runs are then merged with a
+    heap, at most fan_in files at a time.  If dedupe is True each word
+    is only yielded once.  Only strings can be sorted this way, and
+    they must not contain newlines.
+    """
+    assert tempfile != None, "external_sort needs temporary files"
+    assert fan_in >= 2, "external_sort needs a fan_in of at least 2"
+    filenames = []
+    try:
+        run = []
+        for word in iterable1:
+            run.append(word)
+            if len(run) >= run_size:
+                run.sort()
+                filenames.append(_write_run(run, temp_dir))
+                run = []
+        if run:
+            run.sort()
+            filenames.append(_write_run(run, temp_dir))
+        run = None
+        
+        # merge in passes until the last merge fits in fan_in files
+        while len(filenames) > fan_in:
+            groups = [filenames[start:start + fan_in]
+                      for start in range(0, len(filenames), fan_in)]
+            for group in groups:
+                filenames.append(_write_run(_merge_runs(group), temp_dir))
+                for filename in group:
+                    os.remove(filename)
+                    filenames.remove(filename)
+
+        merged = _merge_runs(filenames)
+        if dedupe:
+            merged = iter_remove_duplicates(merged)
+        for word in merged:
+            yield word
+    finally:
+        for filename in filenames:
+            os.remove(filename)
+
+def sort_word_file(in_filename, out_filename, run_size = RUN_SIZE, 
+                   dedupe = True):
+    """
+    Sort the words in in_filename, one per line, into out_filename
+    using external_sort.
+    """
+    out_file = open(out_filename, "w")
+    try:
+        for word in external_sort(iter_file_words(in_filename), 
+                                  run_size, dedupe):
+            out_file.write(word + "\n")
+    finally:
+        out_file.close()
       
 
 # Function to generate all strings for the word wrangler game
@@ -122,6 +291,90 @@ def gen_all_strings(word):
 
 #zk.run_suite(gen_all_strings)
 
+class Trie:
+    """
+    Prefix tree of words used by iter_all_strings to skip prefixes
+    that do not lead to any word.  Each node is a dictionary from
+    letter to child node, and the key None marks the end of a word.
+    """
+
+    def __init__(self, words = ()):
+        self._root = {}
+        for word in words:
+            self.add_word(word)
+
+    def add_word(self, word):
+        """
+        Add word to the trie
+        """
+        node = self._root
+        for letter in word:
+            node = node.setdefault(letter, {})
+        node[None] = True
+
+    def has_prefix(self, prefix):
+        """
+        Return True if some word in the trie starts with prefix
+        """
+        return self.get_node(prefix) != None
+
+    def is_word(self, word):
+        """
+        Return True if word is in the trie
+        """
+        node = self.get_node(word)
+        return node != None and None in node
+
+    def get_node(self, prefix):
+        """
+        Return the node for prefix, or None if no word starts with it
+        """
+        node = self._root
+        for letter in prefix:
+            node = node.get(letter)
+            if node == None:
+                return None
+        return node
+
+def _iter_strings(prefix, counts, node):
+    """
+    Yield prefix and every distinct extension of it using the letters
+    left in counts.  If node is not None only strings that are words
+    below node are yielded, and prefixes with no node are skipped.
+    """
+    if node == None or None in node:
+        yield prefix
+    for letter in sorted(counts):
+        if counts[letter] == 0:
+            continue
+        child = None
+        if node != None:
+            child = node.get(letter)
+            if child == None:
+                continue
+        counts[letter] -= 1
+        for string in _iter_strings(prefix + letter, counts, child):
+            yield string
+        counts[letter] += 1
+
+def iter_all_strings(word, trie = None):
+    """
+    Lazily yield every distinct string that can be composed from the
+    letters in word in any order, including the empty string.
+
+    Repeated letters are handled through letter counts, so each string
+    is yielded once.  If trie is given only strings that are words in
+    the trie are yielded, and prefixes that lead to no word are never
+    extended.
+    """
+    counts = {}
+    for letter in word:
+        counts[letter] = counts.get(letter, 0) + 1
+    node = None
+    if trie != None:
+        node = trie.get_node("")
+    return _iter_strings("", counts, node)
+
 # Function to load words from a file
 
 def load_words(filename):
@@ -129,17 +382,177 @@ def load_words(filename):
     Load word list from the file named filename.
 
     Returns a list of strings.
+
+    A local file is read line by line through mmap, without copying
+    it into one string first, otherwise the file is fetched from the
+    CodeSkulptor assets url.
+    """
+    if os == None or not os.path.exists(filename):
+        url = codeskulptor.file2url(filename)
+        netfile = urllib2.urlopen(url)
+        try:
+            return [word.strip() for word in netfile.readlines() 
+                    if word.strip()]
+        finally:
+            netfile.close()
+
+    word_file = open(filename, "rb")
+    try:
+        # mmap can't map an empty file
+        if os.fstat(word_file.fileno()).st_size == 0:
+            return []
+        data = mmap.mmap(word_file.fileno(), 0, access = mmap.ACCESS_READ)
+        try:
+            words = []
+            for line in iter(data.readline, ""):
+                word = line.strip()
+                if word:
+                    words.append(word)
+            return words
+        finally:
+            data.close()
+    finally:
+        word_file.close()
+
+# Anagram index for finding the valid words in a hand of letters
+
+def get_signature(word):
+    """
+    Return the sorted-letter signature shared by all anagrams of word
+    """
+    return "".join(sorted(word))
+
+class AnagramIndex:
+    """
+    Index of a word list keyed by sorted-letter signature, so all the
+    anagrams of a set of letters are found with one lookup.
+    """
+
+    def __init__(self, words = (), index = None):
+        """
+        Index words, adding them to index, a dictionary from signature
+        to sorted list of words such as a saved index
+        """
+        if index == None:
+            index = {}
+        self._index = index
+        for word in words:
+            self.add_word(word)
+
+    def __len__(self):
+        """
+        Return the number of signatures in the index
+        """
+        return len(self._index)
+
+    def add_word(self, word):
+        """
+        Add word to the index
+        """
+        anagrams = self._index.setdefault(get_signature(word), [])
+        if word not in anagrams:
+            anagrams.append(word)
+            anagrams.sort()
+
+    def get_anagrams(self, word):
+        """
+        Return a sorted list of the words that use exactly the letters
+        of word
+        """
+        return self._index.get(get_signature(word), [])[:]
+
+    def gen_sub_anagrams(self, word):
+        """
+        Return a sorted list of the words that can be made from some or
+        all of the letters of word.
+
+        Walks each sub-multiset of the letters once, so a word with
+        repeated letters needs far fewer lookups than the n! strings
+        gen_all_strings makes.
+        """
+        counts = []
+        for letter in get_signature(word):
+            if counts and counts[-1][0] == letter:
+                counts[-1][1] += 1
+            else:
+                counts.append([letter, 1])
+
+        found = []
+        signatures = [""]
+        # grow the signatures by zero or more copies of each letter in
+        # turn, which keeps every signature in sorted order
+        for letter, count in counts:
+            signatures = [signature + letter * num 
+                          for signature in signatures
+                          for num in range(count + 1)]
+        for signature in signatures:
+            found += self._index.get(signature, [])
+        found.sort()
+        return found
+
+    def save(self, filename, source = None):
+        """
+        Save the index to filename.  If source is the name of the word
+        file it was built from, load_index checks it is unchanged.
+        """
+        stamp = None
+        if source != None:
+            stamp = (os.path.getsize(source), os.path.getmtime(source))
+        index_file = open(filename, "wb")
+        try:
+            pickle.dump((stamp, self._index), index_file, 
+                        pickle.HIGHEST_PROTOCOL)
+        finally:
+            index_file.close()
+
+def load_index(filename, source = None):
+    """
+    Return the AnagramIndex saved in filename, or None if there is no
+    saved index or source has changed since it was saved.
+    """
+    if not os.path.exists(filename):
+        return None
+    index_file = open(filename, "rb")
+    try:
+        stamp, index_dict = pickle.load(index_file)
+    finally:
+        index_file.close()
+    if source != None and stamp != (os.path.getsize(source), 
+                                    os.path.getmtime(source)):
+        return None
+    return AnagramIndex(index = index_dict)
+
+def get_index(filename, index_filename = INDEXFILE, words = None):
+    """
+    Return the anagram index for the word file filename, loading it
+    from index_filename when it is up to date and building and saving
+    it otherwise.  words is the word list of filename if it has already
+    been loaded, so it is not read again.
     """
-    return []
+    if os == None or not os.path.exists(filename):
+        # no local file to save an index for
+        if words == None:
+            words = load_words(filename)
+        return AnagramIndex(words)
+    index = load_index(index_filename, filename)
+    if index == None:
+        if words == None:
+            words = load_words(filename)
+        index = AnagramIndex(words)
+        index.save(index_filename, filename)
+    return index
 
 def run():
     """
     Run game.
     """
     words = load_words(WORDFILE)
+    # the index only returns valid words, so the game's intersect
+    # with the word list keeps all of them
+    index = get_index(WORDFILE, INDEXFILE, words)
     wrangler = provided.WordWrangler(words, remove_duplicates, 
                                      intersect, merge_sort, 
-                                     gen_all_strings)
+                                     index.gen_sub_anagrams)
     provided.run_game(wrangler)
 
 # Uncomment when you are ready to try the game